@@ -10,12 +10,22 @@ import requests
 from tqdm import tqdm
 
 from aitw.database.connection import connect
+from aitw.database.repository import WITH_METADATA
+
+# Columns of the published archive, the tables also hold columns that are only used internally
+# (e.g. the content_hash of a pull request)
+PRS_COLUMNS = [
+    'id', 'agent', 'url', 'title', 'description', 'created_at', 'closed_at', 'merged', 'is_draft', 'additions', 'deletions',
+    'changed_files', 'comments', 'commits', 'reviewers', 'base_repo_id', 'head_repo_id', 'base_ref', 'head_ref', 'author_login',
+    'author_type', 'files', 'commits_list', 'comments_list', 'primary_language'
+]
+REPOS_COLUMNS = ['id', 'name', 'url', 'fork', 'forks', 'watchers', 'stars', 'primary_language']
 
 def prs(dbconn, output):
     conn = connect(dbconn)
     
     with conn.cursor() as cur, gzip.open(output, 'wb') as gz:
-        copy_sql = "COPY (SELECT * FROM prs WHERE created_at > '2025-05-15') TO STDOUT WITH CSV HEADER"
+        copy_sql = f"COPY (SELECT {', '.join(PRS_COLUMNS)} FROM prs WHERE created_at > '2025-05-15') TO STDOUT WITH CSV HEADER"
         with cur.copy(copy_sql) as cop, tqdm(
                 unit='B',
                 unit_scale=True,
@@ -32,7 +42,7 @@ def repos(dbconn, output):
     conn = connect(dbconn)
     
     with conn.cursor() as cur, gzip.open(output, 'wb') as gz:
-        copy_sql = "COPY (SELECT * FROM repos) TO STDOUT WITH CSV HEADER"
+        copy_sql = f"COPY (SELECT {', '.join(REPOS_COLUMNS)} FROM repos WHERE {WITH_METADATA}) TO STDOUT WITH CSV HEADER"
         with cur.copy(copy_sql) as cop, tqdm(
                 unit='B',
                 unit_scale=True,
@@ -0,0 +1,212 @@
+import os
+import json
+import time
+import resource
+import logging
+
+from dataclasses import asdict
+from datetime import datetime, timezone
+from typing import Any, Callable, Dict, List, Optional
+
+import click
+import orjson
+import requests
+from dacite import from_dict
+from psycopg.conninfo import make_conninfo
+
+from aitw.bench.fake_github import Dataset, minute_windows, serve
+from aitw.database import pull_request_codec
+from aitw.database.connection import connect, connection, pool_stats
+from aitw.database.pull_request import Comment, Commit, PullRequest, PullRequestFile
+from aitw.database.pull_request_ingestor import BatchedPullRequestIngestor, content_hash
+from aitw.database.schema import migrate
+from aitw.scrape.job import CreateScrapeJob, JobManager
+from aitw.scrape.page_size import PageSizeController
+from aitw.scrape.scraper import GitHubScraper
+from aitw.scrape.token_pool import TokenPool
+from aitw.scrape.worker import work
+
+BENCH_SCHEMA = "aitw_bench"
+BENCH_GROUP = "bench"
+BENCH_START = datetime(2025, 6, 1, tzinfo=timezone.utc)
+
+
+def bench_conninfo(db_conninfo: str) -> str:
+    """The benchmark works in its own schema so that it can be pointed at a database with real data."""
+    return make_conninfo(db_conninfo, options=f"-c search_path={BENCH_SCHEMA}")
+
+
+def reset_schema(db_conninfo: str):
+    conn = connect(db_conninfo)
+    with conn.cursor() as cur:
+        cur.execute(f"DROP SCHEMA IF EXISTS {BENCH_SCHEMA} CASCADE")
+        cur.execute(f"CREATE SCHEMA {BENCH_SCHEMA}")
+    conn.commit()
+    conn.close()
+
+    conn = connect(bench_conninfo(db_conninfo))
+    migrate(conn)
+    conn.close()
+
+
+def count_rows(db_conninfo: str) -> Dict[str, int]:
+    with connection(db_conninfo) as conn, conn.cursor() as cur:
+        counts = {}
+        for table in ["prs", "repos"]:
+            cur.execute(f"SELECT COUNT(*) FROM {table}")
+            counts[table] = cur.fetchone()[0]
+        cur.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status")
+        counts.update({f"jobs_{status}": count for status, count in cur.fetchall()})
+    return counts
+
+
+def unstable_hashes(db_conninfo: str) -> int:
+    """Pull requests whose row, read back from the database, does not hash to its stored content_hash."""
+    fields = ', '.join(BatchedPullRequestIngestor.select_fields)
+    with connection(db_conninfo) as conn, conn.cursor() as cur:
+        cur.execute(f"SELECT {fields}, content_hash FROM prs")
+        return sum(
+            1 for row in cur
+            if content_hash(BatchedPullRequestIngestor.pr_to_row(BatchedPullRequestIngestor.row_to_pr(row))) != row[-1]
+        )
+
+
+def scrape(db_conninfo: str, minutes=60, density=10.0, latency=0.1, error_rate=0.0, two_phase=False, batch=1,
+           seed=0, recording: Optional[str] = None, time_key="created", tokens=1, concurrency=1) -> Dict[str, Any]:
+    """
+    Scrapes one job per minute from a local fake of the GitHub API into a fresh schema, through the
+    same queue, scraper and ingestors as the worker, and reports the throughput.
+    """
+    start = BENCH_START
+    if recording:
+        # Replay the minutes covered by the recording
+        dataset = Dataset.load(recording)
+        timestamps = dataset.index[time_key][0]
+        start = datetime.fromtimestamp(timestamps[0] - timestamps[0] % 60, tz=timezone.utc)
+        minutes = int(timestamps[-1] - start.timestamp()) // 60 + 1
+    else:
+        dataset = Dataset.synthetic(start, minutes, density, seed=seed)
+    server = serve(dataset, latency=latency, error_rate=error_rate, seed=seed)
+    os.environ["GITHUB_GRAPHQL_URL"] = server.url
+    print(f"🧪 Serving {len(dataset.nodes)} pull requests at {server.url}")
+
+    db = bench_conninfo(db_conninfo)
+    reset_schema(db_conninfo)
+
+    job_manager = JobManager(db)
+    job_manager.create_jobs([
+        CreateScrapeJob(group=BENCH_GROUP, from_date=window_start, to_date=window_end, query="", time_key=time_key)
+        for window_start, window_end in minute_windows(start, minutes)
+    ])
+    job_manager.close()
+
+    token_pool = TokenPool([f"bench-token-{i}" for i in range(tokens)])
+    page_sizes: Dict[str, PageSizeController] = {}
+
+    # Progress bars and per-request logs would dominate the measurement
+    logging.disable(logging.WARNING)
+    start_time = time.time()
+    try:
+        work(token_pool, BENCH_GROUP, db, two_phase=two_phase, batch=batch, concurrency=concurrency, page_sizes=page_sizes, until_idle=True, worker_id="bench")
+    finally:
+        logging.disable(logging.NOTSET)
+        wall_time = time.time() - start_time
+        server_stats = requests.get(server.url).json()
+        server.shutdown()
+        del os.environ["GITHUB_GRAPHQL_URL"]
+
+    rows = count_rows(db)
+    prs = rows["prs"]
+    return {
+        "dataset_prs": len(dataset.nodes),
+        **rows,
+        # Rows that a later upsert of the same content (e.g. by reclassify) would rewrite
+        "unstable_hashes": unstable_hashes(db),
+        "wall_time_s": round(wall_time, 2),
+        "prs_per_s": round(prs / wall_time, 1) if wall_time > 0 else None,
+        "requests": server_stats["requests"],
+        "requests_per_pr": round(server_stats["requests"] / prs, 3) if prs > 0 else None,
+        "errors": server_stats["errors"],
+        "rate_limited": server_stats["rate_limited"],
+        "cost": server_stats["cost"],
+        "peak_rss_mb": round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1),
+        "page_sizes": {key: controller.stats() for key, controller in page_sizes.items()},
+        "db_pool": pool_stats(db),
+    }
+
+
+def best_time(fn: Callable[[], Any], rounds: int) -> float:
+    timings = []
+    for _ in range(rounds):
+        start_time = time.perf_counter()
+        fn()
+        timings.append(time.perf_counter() - start_time)
+    return min(timings)
+
+
+def codec(prs=5000, seed=0, rounds=5) -> Dict[str, Any]:
+    """
+    Times the conversion of the files, commits and comments of synthetic pull requests to JSON
+    columns and back, with aitw.database.pull_request_codec against asdict, json and dacite.
+    """
+    dataset = Dataset.synthetic(BENCH_START, max(prs // 10, 1), 10.0, seed=seed)
+    pulls = [obj for node in dataset.nodes[:prs] for obj in GitHubScraper.parse_node(node, with_repositories=False) if isinstance(obj, PullRequest)]
+    columns = [(pr.files, pr.commitsList, pr.commentsList) for pr in pulls]
+    
+    def dump_legacy() -> List[List[Optional[str]]]:
+        return [[json.dumps([asdict(x) for x in items]) if items is not None else None for items in row] for row in columns]
+    
+    def dump_codec() -> List[List[Optional[str]]]:
+        return [[pull_request_codec.dump(items) for items in row] for row in columns]
+    
+    # As handed over by psycopg, which decodes the JSONB columns with json (legacy) or orjson (codec)
+    texts = dump_codec()
+    
+    def load_legacy():
+        return [
+            (
+                [from_dict(PullRequestFile, x) for x in json.loads(files)] if files is not None else None,
+                [from_dict(Commit, x) for x in json.loads(commits)] if commits is not None else None,
+                [from_dict(Comment, x) for x in json.loads(comments)] if comments is not None else None,
+            )
+            for files, commits, comments in texts
+        ]
+    
+    def load_codec():
+        return [
+            (
+                pull_request_codec.load_files(orjson.loads(files) if files is not None else None),
+                pull_request_codec.load_commits(orjson.loads(commits) if commits is not None else None),
+                pull_request_codec.load_comments(orjson.loads(comments) if comments is not None else None),
+            )
+            for files, commits, comments in texts
+        ]
+    
+    def decoded(rows: List[List[Optional[str]]]) -> List[Any]:
+        return [json.loads(text) if text is not None else None for row in rows for text in row]
+    
+    # Both paths have to produce the same JSON and the same objects
+    identical = decoded(dump_legacy()) == decoded(texts) and load_legacy() == load_codec() == columns
+    
+    dump_legacy_s, dump_codec_s = best_time(dump_legacy, rounds), best_time(dump_codec, rounds)
+    load_legacy_s, load_codec_s = best_time(load_legacy, rounds), best_time(load_codec, rounds)
+    return {
+        "prs": len(pulls),
+        "json_mb": round(sum(len(text) for row in texts for text in row if text is not None) / 1e6, 1),
+        "identical": identical,
+        "dump_legacy_ms": round(dump_legacy_s * 1000, 1),
+        "dump_codec_ms": round(dump_codec_s * 1000, 1),
+        "dump_speedup": round(dump_legacy_s / dump_codec_s, 1),
+        "load_legacy_ms": round(load_legacy_s * 1000, 1),
+        "load_codec_ms": round(load_codec_s * 1000, 1),
+        "load_speedup": round(load_legacy_s / load_codec_s, 1),
+    }
+
+
+def print_report(report: Dict[str, Any]):
+    click.echo(json.dumps(report, indent=2))
+    if report["dataset_prs"] != report["prs"]:
+        click.echo(f"⚠️  Scraped {report['prs']} of {report['dataset_prs']} pull requests")
+    else:
+        click.echo(f"✅ Scraped {report['prs']} pull requests at {report['prs_per_s']} PRs/s, "
+                   f"{report['requests_per_pr']} requests/PR, peak RSS {report['peak_rss_mb']} MB")
@@ -0,0 +1,339 @@
+"""
+Offline stand-in for the GitHub GraphQL API.
+
+Serves the documents of aitw.scrape.queries from recorded or synthetic pull requests and simulates
+the parts of the real API that matter for scraping throughput: latency, rate limit headers, 5xx
+errors and the 1,000 result cap of the search.
+"""
+
+import base64
+import json
+import random
+import re
+import threading
+import time
+
+from bisect import bisect_left, bisect_right
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Any, Dict, List, Optional, Tuple
+
+SEARCH_LIMIT = 1000
+SEARCH_PATTERN = re.compile(r'(created|closed|updated):(\S+)\.\.(\S+)')
+TIME_KEYS = {'created': 'createdAt', 'closed': 'closedAt', 'updated': 'updatedAt'}
+
+BRANCHES = ['feature/', 'fix/', 'codex/', 'copilot/', 'cursor/', 'claude/', 'main', 'patch-']
+EXTENSIONS = ['py', 'ts', 'tsx', 'js', 'rs', 'go', 'java', 'md', 'json', 'yml']
+
+
+def to_timestamp(date: str) -> float:
+    return datetime.fromisoformat(date.replace('Z', '+00:00')).replace(tzinfo=timezone.utc).timestamp()
+
+
+def to_iso(timestamp: float) -> str:
+    return datetime.fromtimestamp(timestamp, tz=timezone.utc).strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+class Dataset:
+    """Pull request nodes (in the shape of the full query profile) indexed by their timestamps."""
+
+    def __init__(self, nodes: List[Dict[str, Any]]):
+        self.nodes = nodes
+        self.by_id = {node['id']: node for node in nodes}
+        self.repositories = {
+            repo['id']: repo
+            for node in nodes for repo in [node.get('baseRepository'), node.get('headRepository')] if repo and 'id' in repo
+        }
+        # Legacy node ids ("010:Repository<id>" in base64) resolve to the same repositories
+        self.repositories.update({
+            base64.b64encode(f"010:Repository{repo['databaseId']}".encode()).decode(): repo for repo in list(self.repositories.values())
+        })
+        self.index: Dict[str, Tuple[List[float], List[int]]] = {}
+
+        for time_key, field in TIME_KEYS.items():
+            keyed = sorted((to_timestamp(node[field]), i) for i, node in enumerate(nodes) if node[field] is not None)
+            self.index[time_key] = ([t for t, _ in keyed], [i for _, i in keyed])
+
+    def search(self, time_key: str, start: float, end: float) -> List[Dict[str, Any]]:
+        timestamps, indices = self.index[time_key]
+        return [self.nodes[i] for i in indices[bisect_left(timestamps, start):bisect_right(timestamps, end)]]
+
+    @staticmethod
+    def load(path: str) -> 'Dataset':
+        """Loads recorded search nodes (one JSON object per line, as returned by the full profile)."""
+        with open(path) as f:
+            nodes = [json.loads(line) for line in f if line.strip()]
+
+        for node in nodes:
+            node.setdefault('id', f"PR_{node['fullDatabaseId']}")
+        return Dataset(nodes)
+
+    @staticmethod
+    def synthetic(start: datetime, minutes: int, density: float, seed: int = 0, burst_rate=0.01) -> 'Dataset':
+        """
+        Generates pull requests with `density` pull requests per minute on average. A fraction of the
+        minutes (`burst_rate`) is a burst with 50x the density, to exercise splitting of dense windows.
+        """
+        rng = random.Random(seed)
+        start_ts = start.replace(tzinfo=timezone.utc).timestamp()
+        repos = [Dataset.synthetic_repository(rng, i) for i in range(max(int(minutes * density / 20), 1))]
+
+        nodes: List[Dict[str, Any]] = []
+        for minute in range(minutes):
+            count = int(rng.expovariate(1 / density)) if density > 0 else 0
+            if rng.random() < burst_rate:
+                count *= 50
+
+            for _ in range(count):
+                created = start_ts + minute * 60 + rng.random() * 60
+                nodes.append(Dataset.synthetic_pull_request(rng, len(nodes) + 1, created, rng.choice(repos)))
+
+        return Dataset(nodes)
+
+    @staticmethod
+    def synthetic_repository(rng: random.Random, i: int) -> Dict[str, Any]:
+        return {
+            'id': f'R_{i}',
+            'databaseId': i,
+            'nameWithOwner': f'owner{i}/repo{i}',
+            'url': f'https://github.com/owner{i}/repo{i}',
+            'isFork': rng.random() < 0.1,
+            'stargazerCount': int(rng.paretovariate(1)) - 1,
+            'forkCount': int(rng.paretovariate(1.5)) - 1,
+            'watchers': {'totalCount': int(rng.paretovariate(1.5))},
+            'primaryLanguage': {'name': rng.choice(['Python', 'TypeScript', 'Rust', 'Go'])},
+        }
+
+    @staticmethod
+    def synthetic_pull_request(rng: random.Random, i: int, created: float, repo: Dict[str, Any]) -> Dict[str, Any]:
+        closed = created + rng.expovariate(1 / 3600) if rng.random() < 0.6 else None
+        merged = closed if closed is not None and rng.random() < 0.7 else None
+        updated = max(created, closed or created) + rng.random() * 60
+
+        files = [
+            {'additions': rng.randint(0, 200), 'deletions': rng.randint(0, 100), 'path': f'src/file{j}.{rng.choice(EXTENSIONS)}'}
+            for j in range(min(int(rng.paretovariate(1.2)), 300))
+        ]
+        comments = [
+            {
+                'databaseId': i * 1000 + j,
+                'createdAt': to_iso(created + j * 60),
+                'author': {'login': f'user{rng.randint(1, 1000)}', '__typename': 'User'},
+                'bodyText': 'lorem ipsum ' * rng.randint(1, 50),
+            }
+            for j in range(min(int(rng.expovariate(1 / 2)), 150))
+        ]
+        branch = rng.choice(BRANCHES)
+
+        return {
+            'id': f'PR_{i}',
+            'fullDatabaseId': i,
+            'title': f'Pull request {i}',
+            'url': f"{repo['url']}/pull/{i}",
+            'bodyText': 'lorem ipsum ' * rng.randint(0, 100),
+            'createdAt': to_iso(created),
+            'mergedAt': to_iso(merged) if merged is not None else None,
+            'closedAt': to_iso(closed) if closed is not None else None,
+            'updatedAt': to_iso(updated),
+            'isDraft': rng.random() < 0.1,
+            'changedFiles': len(files),
+            'additions': sum(f['additions'] for f in files),
+            'deletions': sum(f['deletions'] for f in files),
+            'author': {'login': f'user{rng.randint(1, 1000)}', '__typename': 'Bot' if rng.random() < 0.05 else 'User'},
+            'comments': {'totalCount': len(comments), 'nodes': comments},
+            'reviews': {'totalCount': rng.randint(0, 3)},
+            'commits': {
+                'totalCount': rng.randint(1, 10),
+                'nodes': [{'commit': {'authors': {'nodes': [{'name': f'user{i}', 'email': f'user{i}@example.com'}]}}}],
+            },
+            'files': {'totalCount': len(files), 'nodes': files},
+            'baseRefName': 'main',
+            'baseRepository': repo,
+            'headRefName': branch + str(i) if branch.endswith('/') or branch.endswith('-') else branch,
+            'headRepository': repo,
+        }
+
+
+class FakeGitHub:
+    """Answers the GraphQL documents of the scraper and keeps per token rate limits and request stats."""
+
+    def __init__(self, dataset: Dataset, latency=0.1, latency_per_node=0.001, error_rate=0.0, rate_limit=5000, seed=0):
+        self.dataset = dataset
+        self.latency = latency
+        self.latency_per_node = latency_per_node
+        self.error_rate = error_rate
+        self.rate_limit = rate_limit
+
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.budgets: Dict[str, Tuple[int, float]] = {} # token -> (remaining, reset at)
+        self.stats = {'requests': 0, 'errors': 0, 'rate_limited': 0, 'nodes': 0, 'cost': 0}
+
+    def handle(self, token: str, body: Dict[str, Any]) -> Tuple[int, Dict[str, str], Dict[str, Any]]:
+        """Returns status code, headers and JSON body for a GraphQL request."""
+        with self.lock:
+            self.stats['requests'] += 1
+            failed = self.rng.random() < self.error_rate
+            remaining, reset_at = self.budgets.get(token, (self.rate_limit, time.time() + 3600))
+            if reset_at <= time.time():
+                remaining, reset_at = self.rate_limit, time.time() + 3600
+
+        if failed:
+            with self.lock:
+                self.stats['errors'] += 1
+            time.sleep(self.latency)
+            return 502, {}, {'message': 'Server Error'}
+
+        if remaining <= 0:
+            with self.lock:
+                self.stats['rate_limited'] += 1
+            return 403, self.rate_limit_headers(0, reset_at), {'message': 'API rate limit exceeded'}
+
+        data, nodes = self.execute(body['query'], body.get('variables') or {})
+        errors = data.pop('errors', None)
+        cost = max(1, nodes // 100)
+        remaining = max(remaining - cost, 0)
+        with self.lock:
+            self.budgets[token] = (remaining, reset_at)
+            self.stats['nodes'] += nodes
+            self.stats['cost'] += cost
+
+        data['rateLimit'] = {'limit': self.rate_limit, 'cost': cost, 'remaining': remaining, 'resetAt': to_iso(reset_at)}
+        time.sleep(self.latency + nodes * self.latency_per_node)
+        return 200, self.rate_limit_headers(remaining, reset_at), {'data': data, **({'errors': errors} if errors else {})}
+
+    def rate_limit_headers(self, remaining: int, reset_at: float) -> Dict[str, str]:
+        return {
+            'X-RateLimit-Limit': str(self.rate_limit),
+            'X-RateLimit-Remaining': str(remaining),
+            'X-RateLimit-Reset': str(int(reset_at)),
+        }
+
+    def execute(self, document: str, variables: Dict[str, Any]) -> Tuple[Dict[str, Any], int]:
+        """Returns the data of a query and the number of nodes it touched."""
+        data: Dict[str, Any] = {}
+        nodes = 0
+
+        if 'query' in variables:
+            data['search'], nodes = self.search(variables['query'], variables.get('first', 0), variables.get('after'))
+
+        i = 0
+        while f'query{i}' in variables:
+            data[f'search{i}'], count = self.search(variables[f'query{i}'], variables.get(f'first{i}', 0), variables.get(f'after{i}'))
+            nodes += count
+            i += 1
+
+        # nodes(ids:) and node(id:) lookups of unknown ids are null next to a NOT_FOUND error, like on GitHub
+        missing = [id for key in ['commitIds', 'fileIds', 'commentIds', 'repositoryIds'] for id in variables.get(key, [])
+                   if id not in (self.dataset.repositories if key == 'repositoryIds' else self.dataset.by_id)]
+        if 'id' in variables and variables['id'] not in self.dataset.by_id:
+            missing.append(variables['id'])
+        if missing:
+            data['errors'] = [{'type': 'NOT_FOUND', 'message': f"Could not resolve to a node with the global id of '{id}'"} for id in missing]
+
+        if 'commitIds' in variables:
+            data['authors'] = [self.details(id, 'commits') for id in variables['commitIds']]
+            nodes += sum(len(node['commits']['nodes']) + 1 for node in data['authors'] if node)
+        if 'fileIds' in variables:
+            data['files'] = [self.details(id, 'files') for id in variables['fileIds']]
+            nodes += sum(len(node['files']['nodes']) + 1 for node in data['files'] if node)
+        if 'commentIds' in variables:
+            data['discussions'] = [self.details(id, 'comments') for id in variables['commentIds']]
+            nodes += sum(len(node['comments']['nodes']) + 1 for node in data['discussions'] if node)
+
+        if 'repositoryIds' in variables:
+            data['repositories'] = [self.dataset.repositories.get(id) for id in variables['repositoryIds']]
+            nodes += len(data['repositories'])
+
+        if 'id' in variables:
+            connection = 'files' if 'query Files' in document else 'comments'
+            node = self.dataset.by_id.get(variables['id'])
+            data['node'] = {connection: self.page(node[connection]['nodes'], 100, variables.get('after'))} if node else None
+            nodes += len(data['node'][connection]['nodes']) if node else 0
+
+        return data, nodes
+
+    def search(self, query: str, first: int, after: Optional[str]) -> Tuple[Dict[str, Any], int]:
+        match = SEARCH_PATTERN.search(query)
+        if match is None:
+            raise ValueError(f'Unsupported search query: {query}')
+
+        time_key, start, end = match.groups()
+        results = self.dataset.search(time_key, to_timestamp(start), to_timestamp(end))
+
+        page = self.page(results[:SEARCH_LIMIT], first, after)
+        page['issueCount'] = len(results)
+        return page, len(page['nodes'])
+
+    def details(self, id: str, connection: str) -> Optional[Dict[str, Any]]:
+        node = self.dataset.by_id.get(id)
+        if node is None:
+            return None
+
+        if connection == 'commits':
+            return {'id': id, 'commits': node['commits']}
+
+        return {
+            'id': id,
+            connection: {'totalCount': node[connection]['totalCount'], **self.page(node[connection]['nodes'], 100, None)},
+        }
+
+    @staticmethod
+    def page(items: List[Any], first: int, after: Optional[str]) -> Dict[str, Any]:
+        offset = int(after) if after else 0
+        nodes = items[offset:offset + first]
+        return {
+            'pageInfo': {'endCursor': str(offset + len(nodes)), 'hasNextPage': offset + len(nodes) < len(items)},
+            'nodes': nodes,
+        }
+
+
+class FakeGitHubServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, github: FakeGitHub, port=0):
+        super().__init__(('127.0.0.1', port), FakeGitHubHandler)
+        self.github = github
+
+    @property
+    def url(self) -> str:
+        return f'http://127.0.0.1:{self.server_address[1]}/graphql'
+
+
+class FakeGitHubHandler(BaseHTTPRequestHandler):
+    server: FakeGitHubServer
+
+    def do_POST(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+        token = self.headers.get('Authorization', '').removeprefix('Bearer ')
+
+        status, headers, payload = self.server.github.handle(token, body)
+        self.respond(status, headers, payload)
+
+    def do_GET(self):
+        # Request statistics for benchmarks
+        self.respond(200, {}, self.server.github.stats)
+
+    def respond(self, status: int, headers: Dict[str, str], payload: Dict[str, Any]):
+        content = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(content)))
+        for key, value in headers.items():
+            self.send_header(key, value)
+        self.end_headers()
+        self.wfile.write(content)
+
+    def log_message(self, format, *args):
+        pass
+
+
+def serve(dataset: Dataset, port=0, **kwargs) -> FakeGitHubServer:
+    """Starts the fake API on a background thread, stop it with `shutdown()`."""
+    server = FakeGitHubServer(FakeGitHub(dataset, **kwargs), port=port)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def minute_windows(start: datetime, minutes: int) -> List[Tuple[datetime, datetime]]:
+    return [(start + timedelta(minutes=m), start + timedelta(minutes=m + 1)) for m in range(minutes)]
@@ -1,12 +1,17 @@
 import os
+import json
 import uuid
 import click
 
 import aitw.insights.insights as insights_file
 import aitw.scrape.worker as scrape_worker
 import aitw.scrape.manager as scrape_manager
+import aitw.scrape.repos as scrape_repos
 import aitw.archive.archive as archive_file
 import aitw.scrape.pr_classifier as pr_classifier
+import aitw.database.schema as database_schema
+from aitw.scrape.planner import TARGET_PRS
+from aitw.scrape.repos import REFRESH_BATCH
 
 import dotenv
 dotenv.load_dotenv(override=True)
@@ -20,12 +25,26 @@ def scrape():
     pass
 
 @scrape.command()
-@click.option('--token', default=lambda: os.getenv('GITHUB_TOKEN'), required=True)
+@click.option('--token', 'tokens', multiple=True, default=lambda: os.getenv('GITHUB_TOKEN', '').split(','), required=True,
+              help='GitHub token, repeat the option (or comma-separate GITHUB_TOKEN) to use a token pool')
 @click.option('--id', default=lambda: uuid.uuid4())
 @click.option('--group')
 @click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
-def worker(token, id, group, db):
-    scrape_worker.worker(token, id, group, db)
+@click.option('--two-phase', is_flag=True, help='Page searches with light nodes and fetch comments, commits and files in batched node lookups')
+@click.option('--batch', default=1, help='Number of jobs to claim at once and scrape with aliased searches in shared requests')
+@click.option('--concurrency', default=1, help='Number of jobs (or batches of jobs) to run at once in this process')
+def worker(tokens, id, group, db, two_phase, batch, concurrency):
+    scrape_worker.worker([t for t in tokens if t], id, group, db, two_phase=two_phase, batch=batch, concurrency=concurrency)
+    
+@scrape.command('repos')
+@click.option('--token', 'tokens', multiple=True, default=lambda: os.getenv('GITHUB_TOKEN', '').split(','), required=True,
+              help='GitHub token, repeat the option (or comma-separate GITHUB_TOKEN) to use a token pool')
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+@click.option('--batch', default=REFRESH_BATCH, help='Repositories per lookup')
+@click.option('--max-age', default=7, help='Days after which the metadata of a repository is refreshed')
+@click.option('--once', is_flag=True, help='Stop once every repository is fresh')
+def refresh_repos(tokens, db, batch, max_age, once):
+    scrape_repos.refresh([t for t in tokens if t], db, batch=batch, max_age=max_age * 24 * 3600, once=once)
     
 @scrape.group()
 def manager():
@@ -37,6 +56,33 @@ def manager():
 def stats(group, db):
     scrape_manager.stats(group, db)
     
+@manager.command()
+@click.argument("group")
+@click.argument("weight", type=float)
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+def weight(group, weight, db):
+    scrape_manager.weight(group, weight, db)
+    
+@manager.command()
+@click.option('--group')
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+def quarantined(group, db):
+    scrape_manager.quarantined(group, db)
+    
+@manager.command()
+@click.option('--group')
+@click.option('--id', 'ids', type=int, multiple=True, help='Only requeue these jobs, repeat the option for several')
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+def requeue(group, ids, db):
+    scrape_manager.requeue(group, ids, db)
+    
+@manager.command()
+@click.option('--group')
+@click.option('--older-than', default=24, help='Hours since the jobs were done')
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+def compact(group, older_than, db):
+    scrape_manager.compact(group, db, older_than=older_than * 3600)
+    
 @manager.command()
 @click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
 def monitor(db):
@@ -44,13 +90,29 @@ def monitor(db):
     
 @manager.command()
 @click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
-def update(db):
-    scrape_manager.update(db)
+@click.option('--target', default=TARGET_PRS, help='Expected pull requests per job')
+@click.option('--token', 'tokens', multiple=True, help='Probe the density with search counts using these GitHub tokens instead of our own history')
+@click.option('--priority', default=0, help='Jobs with a higher priority are leased before the open jobs of the group with a lower one')
+def update(db, target, tokens, priority):
+    scrape_manager.update(db, target=target, tokens=list(tokens), priority=priority)
+    
+@manager.command()
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+@click.option('--group', default='sync')
+@click.option('--window', default=300, help='Seconds of updates per job')
+@click.option('--lag', default=15, help='Minutes to stay behind the search index')
+@click.option('--since', default=7, help='Days to sync on the first run of the group')
+@click.option('--priority', default=0, help='Jobs with a higher priority are leased before the open jobs of the group with a lower one')
+def sync(db, group, window, lag, since, priority):
+    scrape_manager.sync(db, group=group, window=window, lag=lag, since=since, priority=priority)
     
 @manager.command()
 @click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
-def backfill(db):
-    scrape_manager.backfill(db)
+@click.option('--target', default=TARGET_PRS, help='Expected pull requests per job')
+@click.option('--token', 'tokens', multiple=True, help='Probe the density with search counts using these GitHub tokens instead of our own history')
+@click.option('--priority', default=0, help='Jobs with a higher priority are leased before the open jobs of the group with a lower one')
+def backfill(db, target, tokens, priority):
+    scrape_manager.backfill(db, target=target, tokens=list(tokens), priority=priority)
     
 @cli.command()
 @click.argument('insight', required=True)
@@ -94,5 +156,48 @@ def upload(db, token, files):
 def reclassify(db):
     pr_classifier.reclassify(db)
 
+@cli.group()
+def database():
+    pass
+
+@database.command()
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True)
+def migrate(db):
+    database_schema.migrate_db(db)
+
+@cli.group()
+def bench():
+    pass
+
+@bench.command(name='scrape')
+@click.option('--db', envvar='POSTGRES_CONNECT_BACKEND', required=True, help='The benchmark only touches the aitw_bench schema')
+@click.option('--minutes', default=60, help='Number of one minute jobs')
+@click.option('--density', default=10.0, help='Average number of synthetic pull requests per minute')
+@click.option('--latency', default=0.1, help='Base latency of the fake API in seconds')
+@click.option('--error-rate', default=0.0, help='Fraction of requests answered with a 502')
+@click.option('--time-key', default='created', type=click.Choice(['created', 'closed', 'updated']))
+@click.option('--tokens', default=1, help='Number of (fake) tokens in the pool')
+@click.option('--two-phase', is_flag=True)
+@click.option('--batch', default=1)
+@click.option('--concurrency', default=1)
+@click.option('--seed', default=0)
+@click.option('--recording', type=click.Path(exists=True), help='JSONL file of recorded search nodes to replay instead of synthetic ones')
+def bench_scrape(db, minutes, density, latency, error_rate, time_key, tokens, two_phase, batch, concurrency, seed, recording):
+    import aitw.bench.bench as bench_file
+    bench_file.print_report(bench_file.scrape(
+        db, minutes=minutes, density=density, latency=latency, error_rate=error_rate, two_phase=two_phase,
+        batch=batch, seed=seed, recording=recording, time_key=time_key, tokens=tokens, concurrency=concurrency,
+    ))
+
+@bench.command(name='codec')
+@click.option('--prs', default=5000, help='Number of synthetic pull requests')
+@click.option('--rounds', default=5, help='Repetitions, the fastest is reported')
+@click.option('--seed', default=0)
+def bench_codec(prs, rounds, seed):
+    import aitw.bench.bench as bench_file
+    report = bench_file.codec(prs=prs, seed=seed, rounds=rounds)
+    click.echo(json.dumps(report, indent=2))
+    click.echo(f"✅ Serialized {report['prs']} pull requests {report['dump_speedup']}x and deserialized them {report['load_speedup']}x faster")
+
 if __name__ == '__main__':
     cli()
\ No newline at end of file
@@ -1,4 +1,83 @@
+import atexit
+import logging
+import threading
+from typing import Any, Dict, Optional
+
 import psycopg
+from psycopg_pool import ConnectionPool
+
+POOL_MIN_SIZE = 1
+POOL_MAX_SIZE = 4 # Per database and process, workers running several jobs at once grow it with ensure_pool_size
+POOL_MAX_IDLE = 300 # Seconds before idle connections above the minimum are closed
+POOL_MAX_LIFETIME = 3600 # Seconds before a connection is replaced, e.g. to pick up a failover
+POOL_RECONNECT_TIMEOUT = 300 # Seconds to keep trying to reconnect before the pool reports a failure
+
+pools: Dict[str, ConnectionPool] = {}
+pools_lock = threading.Lock()
 
 def connect(conninfo):
-    return psycopg.connect(conninfo)
\ No newline at end of file
+    """A new connection that is not pooled, for long-lived connections (e.g. server-side cursors)."""
+    return psycopg.connect(conninfo)
+
+def get_pool(conninfo) -> ConnectionPool:
+    """
+    The connection pool of the process for the database, created on first use. Connections are
+    checked before they are handed out, broken ones are replaced (reconnecting in the background).
+    """
+    with pools_lock:
+        pool = pools.get(conninfo)
+        if pool is None:
+            pool = ConnectionPool(
+                conninfo,
+                min_size=POOL_MIN_SIZE,
+                max_size=POOL_MAX_SIZE,
+                max_idle=POOL_MAX_IDLE,
+                max_lifetime=POOL_MAX_LIFETIME,
+                reconnect_timeout=POOL_RECONNECT_TIMEOUT,
+                check=ConnectionPool.check_connection,
+                reconnect_failed=lambda pool: logging.error(f'❌ Could not reconnect to the database ({pool.name})'),
+                open=True,
+            )
+            pools[conninfo] = pool
+        return pool
+
+def ensure_pool_size(conninfo, max_size: int):
+    """Grows the pool of the database to at least `max_size` connections."""
+    pool = get_pool(conninfo)
+    with pools_lock:
+        if pool.max_size < max_size:
+            pool.resize(min_size=pool.min_size, max_size=max_size)
+
+def connection(conninfo):
+    """
+    Context manager for a pooled connection. It commits on success, rolls back on errors and then
+    returns the connection to the pool.
+    """
+    return get_pool(conninfo).connection()
+
+def pool_stats(conninfo) -> Dict[str, Any]:
+    """Size, usage and wait times of the pool of the database (counters since it was created)."""
+    pool: Optional[ConnectionPool] = pools.get(conninfo)
+    if pool is None:
+        return {}
+
+    stats = pool.get_stats()
+    return {
+        'size': stats.get('pool_size', 0),
+        'available': stats.get('pool_available', 0),
+        'max_size': pool.max_size,
+        'requests': stats.get('requests_num', 0),
+        'waiting': stats.get('requests_waiting', 0),
+        'queued': stats.get('requests_queued', 0),
+        'wait_ms': stats.get('requests_wait_ms', 0),
+        'usage_ms': stats.get('usage_ms', 0),
+        'errors': stats.get('requests_errors', 0) + stats.get('connections_errors', 0),
+        'lost': stats.get('connections_lost', 0),
+    }
+
+@atexit.register
+def close_pools():
+    with pools_lock:
+        for pool in pools.values():
+            pool.close()
+        pools.clear()
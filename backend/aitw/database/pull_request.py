@@ -2,34 +2,34 @@
 from dataclasses import dataclass
 from typing import List
 
-@dataclass
+@dataclass(slots=True)
 class CommitAuthor:
     name: str
     email: str
     
-@dataclass
+@dataclass(slots=True)
 class Commit:
     authors: List[CommitAuthor]
     
-@dataclass
+@dataclass(slots=True)
 class Actor:    
     login: str
     type: str
 
-@dataclass
+@dataclass(slots=True)
 class Comment:
     id: int
     created_at: str
     author: Actor | None # may got deleted
     body: str
     
-@dataclass
+@dataclass(slots=True)
 class PullRequestFile:
     additions: int
     deletions: int
     path: str
 
-@dataclass
+@dataclass(slots=True)
 class PullRequest:
     id: int
     url: str
@@ -63,4 +63,12 @@ class PullRequest:
     
     agent: str | None = None
     primary_language: str | None = None
-   
\ No newline at end of file
+    updated_at: str | None = None
+
+@dataclass(slots=True)
+class PullRequestStatus:
+    id: int
+    
+    closed_at: str | None
+    isMerged: bool
+    isDraft: bool
@@ -0,0 +1,56 @@
+"""
+Conversion of the nested lists of a PullRequest (files, commits and comments) from and to the JSONB
+columns of the prs table.
+
+The model classes are slotted dataclasses that orjson serializes natively, so no intermediate
+dicts are built when writing. When reading, psycopg hands the JSONB columns to orjson (see
+`register`) and the classes are constructed directly from the decoded dicts.
+"""
+
+from typing import Any, Dict, List, Optional
+
+import orjson
+from psycopg.types.json import set_json_loads
+
+from aitw.database.pull_request import Actor, Comment, Commit, CommitAuthor, PullRequestFile
+
+
+def register(conn):
+    """Lets psycopg decode the json/jsonb columns of the connection with orjson."""
+    set_json_loads(orjson.loads, conn)
+
+
+def dump(items: Optional[List[Any]]) -> Optional[str]:
+    """A list of model objects as JSON text, which psycopg passes on to a JSONB column as it is."""
+    return orjson.dumps(items).decode() if items is not None else None
+
+
+def dump_row(row) -> bytes:
+    """Canonical bytes of a row, e.g. to fingerprint it."""
+    return orjson.dumps(row, default=str)
+
+
+def load_files(data: Optional[List[Dict[str, Any]]]) -> Optional[List[PullRequestFile]]:
+    if data is None:
+        return None
+    return [PullRequestFile(additions=x['additions'], deletions=x['deletions'], path=x['path']) for x in data]
+
+
+def load_commits(data: Optional[List[Dict[str, Any]]]) -> Optional[List[Commit]]:
+    if data is None:
+        return None
+    return [Commit(authors=[CommitAuthor(name=a['name'], email=a['email']) for a in x['authors']]) for x in data]
+
+
+def load_comments(data: Optional[List[Dict[str, Any]]]) -> Optional[List[Comment]]:
+    if data is None:
+        return None
+    return [
+        Comment(
+            id=x['id'],
+            created_at=x['created_at'],
+            author=Actor(login=x['author']['login'], type=x['author']['type']) if x['author'] is not None else None,
+            body=x['body'],
+        )
+        for x in data
+    ]
@@ -1,15 +1,44 @@
-from dataclasses import asdict
-import json
+import hashlib
 import logging
-from typing import List
+from datetime import datetime
+from typing import Any, Dict, List, Optional
 
-from dacite import from_dict
+from aitw.database import pull_request_codec as codec
+from aitw.database.pull_request import Actor, PullRequest, PullRequestStatus
 
-from aitw.database.pull_request import Actor, PullRequest, PullRequestFile, Commit, Comment
+TIMESTAMP_FIELDS = {'created_at', 'closed_at', 'updated_at'}
+JSON_FIELDS = {'files', 'commits_list', 'comments_list'}
+
+
+def canonical_timestamp(value: Optional[str | datetime]) -> Optional[datetime]:
+    """
+    A timestamp as the TIMESTAMP columns store it (naive, the offset is dropped), whether it was
+    scraped as an ISO string or read back from the database.
+    """
+    if value is None:
+        return None
+    if isinstance(value, str):
+        value = datetime.fromisoformat(value)
+    return value.replace(tzinfo=None)
+
+
+def content_hash(row) -> bytes:
+    """
+    Fingerprint of the stored columns of a row, upserts of rows with the same fingerprint are skipped.
+    The values are normalized first, so a scraped row and the same row read back from the database
+    have the same fingerprint.
+    """
+    canonical: List[Any] = [
+        canonical_timestamp(value) if field in TIMESTAMP_FIELDS else
+        None if field in JSON_FIELDS and value == '[]' else
+        value
+        for field, value in zip(BatchedPullRequestIngestor.select_fields, row)
+    ]
+    return hashlib.blake2b(codec.dump_row(canonical), digest_size=16).digest()
 
 
 class BatchedPullRequestIngestor:
-    select_fields = ['id', 'agent', 'url', 'title', 'description', 'created_at', 'closed_at', 'merged', 'is_draft', 'additions', 'deletions', 'changed_files', 'comments', 'commits', 'reviewers', 'base_repo_id', 'head_repo_id', 'base_ref', 'head_ref', 'author_login', 'author_type', 'files', 'commits_list', 'comments_list', 'primary_language']
+    select_fields = ['id', 'agent', 'url', 'title', 'description', 'created_at', 'closed_at', 'merged', 'is_draft', 'additions', 'deletions', 'changed_files', 'comments', 'commits', 'reviewers', 'base_repo_id', 'head_repo_id', 'base_ref', 'head_ref', 'author_login', 'author_type', 'files', 'commits_list', 'comments_list', 'primary_language', 'updated_at']
     
     def __init__(self, conn, cursor, batch_size=100, auto_commit=True):
         self.conn = conn
@@ -17,6 +46,9 @@ class BatchedPullRequestIngestor:
         self.batch_size = batch_size
         self.buffer = []
         self.auto_commit = auto_commit
+        self.staging = False # Whether the staging table of the connection exists
+        self.written = 0
+        self.skipped = 0 # Unchanged pull requests
         
     @staticmethod
     def row_to_pr(row: List):
@@ -41,10 +73,11 @@ class BatchedPullRequestIngestor:
             base_ref = row[17], 
             head_ref = row[18], 
             actor = Actor(row[19], row[20]),
-            files=[from_dict(PullRequestFile, x) for x in row[21]] if row[21] is not None else None,
-            commitsList=[from_dict(Commit, x) for x in row[22]] if row[22] is not None else None,
-            commentsList=[from_dict(Comment, x) for x in row[23]] if row[23] is not None else None,
-            primary_language=row[24]
+            files=codec.load_files(row[21]),
+            commitsList=codec.load_commits(row[22]),
+            commentsList=codec.load_comments(row[23]),
+            primary_language=row[24],
+            updated_at=row[25]
         )
     
     @staticmethod
@@ -71,32 +104,104 @@ class BatchedPullRequestIngestor:
             pr.head_ref,
             pr.actor.login if pr.actor is not None else None,
             pr.actor.type if pr.actor is not None else None,
-            json.dumps([asdict(c) for c in pr.files]) if pr.files is not None else None,
-            json.dumps([asdict(c) for c in pr.commitsList]) if pr.commitsList is not None else None,
-            json.dumps([asdict(c) for c in pr.commentsList]) if pr.commentsList is not None else None,
-            pr.primary_language
+            codec.dump(pr.files),
+            codec.dump(pr.commitsList),
+            codec.dump(pr.commentsList),
+            pr.primary_language,
+            pr.updated_at
         )
 
     def flush(self):
-        self.buffer.sort(key=lambda row: row[0])
-        self.cursor.executemany(
-        f"""
-        INSERT INTO prs ({', '.join([f for f in self.select_fields])})
-        VALUES ({', '.join(['%s' for _ in range(len(self.select_fields))])})
+        if len(self.buffer) == 0:
+            if self.auto_commit:
+                self.conn.commit()
+            return
+        
+        # Streams the batch into a staging table and merges it with a single statement, which is
+        # atomic and locks the rows in the order of their ids (so concurrent workers cannot deadlock).
+        # The last version of a pull request that was ingested twice wins.
+        rows = sorted({row[0]: row for row in self.buffer}.values(), key=lambda row: row[0])
+        fields = ', '.join([*self.select_fields, 'content_hash'])
+        
+        if not self.staging:
+            self.cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS prs_staging (LIKE prs INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+            """)
+            self.staging = True
+        
+        with self.cursor.copy(f"COPY prs_staging ({fields}) FROM STDIN") as copy:
+            for row in rows:
+                copy.write_row(row)
+        
+        self.cursor.execute(f"""
+        INSERT INTO prs ({fields})
+        SELECT {fields} FROM prs_staging ORDER BY id
         ON CONFLICT (id)
-        DO UPDATE SET {',\n'.join([f'{f} = EXCLUDED.{f}' for f in self.select_fields])}
-        """,
-            self.buffer,
-        )
+        DO UPDATE SET {', '.join([f'{f} = EXCLUDED.{f}' for f in [*self.select_fields, 'content_hash']])}
+        WHERE prs.content_hash IS DISTINCT FROM EXCLUDED.content_hash
+        """)
+        written = self.cursor.rowcount
+        self.written += written
+        self.skipped += len(rows) - written
         
+        # The staging table is emptied on commit
         if self.auto_commit:
             self.conn.commit()
+        else:
+            self.cursor.execute("TRUNCATE prs_staging")
 
-        logging.info(f"📊 Ingested {len(self.buffer)} pull requests into db.")
+        logging.info(f"📊 Ingested {len(self.buffer)} pull requests into db ({written} written, {len(rows) - written} unchanged).")
         self.buffer = []
+        
+    def stats(self) -> Dict[str, int]:
+        return {'written': self.written, 'skipped': self.skipped}
 
     def ingest(self, pr: PullRequest):
-        self.buffer.append(BatchedPullRequestIngestor.pr_to_row(pr))
+        row = BatchedPullRequestIngestor.pr_to_row(pr)
+        self.buffer.append((*row, content_hash(row)))
+
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
 
+class BatchedPullRequestStatusIngestor:
+    """Refreshes the status of pull requests that are already stored, unknown pull requests are ignored."""
+    
+    def __init__(self, conn, cursor, batch_size=100):
+        self.conn = conn
+        self.cursor = cursor
+        self.batch_size = batch_size
+        self.buffer = []
+        self.written = 0
+        self.skipped = 0 # Unknown pull requests or unchanged status
+        
+    def flush(self):
+        self.buffer.sort(key=lambda row: row[-1])
+        # The content hash no longer matches the row, the next full upsert rewrites it
+        self.cursor.executemany("""
+        UPDATE prs
+        SET closed_at = %(closed_at)s, merged = %(merged)s, is_draft = %(is_draft)s, content_hash = NULL
+        WHERE id = %(id)s AND (closed_at, merged, is_draft) IS DISTINCT FROM (%(closed_at)s::timestamp, %(merged)s, %(is_draft)s)
+        """, [{'closed_at': closed_at, 'merged': merged, 'is_draft': is_draft, 'id': id} for closed_at, merged, is_draft, id in self.buffer])
+        self.conn.commit()
+        
+        written = max(self.cursor.rowcount, 0)
+        self.written += written
+        self.skipped += len(self.buffer) - written
+        
+        logging.info(f"📊 Refreshed the status of {len(self.buffer)} pull requests in db ({written} changed).")
+        self.buffer = []
+        
+    def stats(self) -> Dict[str, int]:
+        return {'written': self.written, 'skipped': self.skipped}
+        
+    def ingest(self, status: PullRequestStatus):
+        self.buffer.append((
+            status.closed_at,
+            status.isMerged,
+            status.isDraft,
+            status.id
+        ))
+        
         if len(self.buffer) >= self.batch_size:
             self.flush()
@@ -1,6 +1,10 @@
  
 from dataclasses import dataclass
 
+# SQL condition on the repos table for repositories with metadata. The ones that were only referenced
+# so far (see RepositoryRef) are id-only rows until the refresher looked them up
+WITH_METADATA = "repos.name IS NOT NULL"
+
 
 @dataclass
 class Repository:
@@ -16,3 +20,12 @@ class Repository:
     
     primary_language: str
     
+    node_id: str | None = None # GraphQL id, looked up by the repository refresher (aitw.scrape.repos)
+
+
+@dataclass
+class RepositoryRef:
+    """A repository a pull request belongs to, scraped without its metadata (see aitw.scrape.repos)."""
+    id: int
+    node_id: str
+    
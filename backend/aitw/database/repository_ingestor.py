@@ -1,18 +1,72 @@
-from aitw.database.repository import Repository
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict, Iterable, Optional, Tuple
+
+from aitw.database.repository import Repository, RepositoryRef
+
+RECENT_REPOSITORIES = 50000 # Repository rows a worker remembers, about 20 MB
+
+
+class RecentRepositories:
+    """
+    The repository rows a worker wrote last (least recently seen are evicted first), shared by its
+    jobs and their threads. A busy repository comes with every one of its pull requests, as long
+    as it did not change it is not sent to the database again.
+    """
+    
+    def __init__(self, max_size=RECENT_REPOSITORIES):
+        self.max_size = max_size
+        self.rows: OrderedDict[int, Tuple] = OrderedDict()
+        self.lock = threading.Lock()
+        
+    def unchanged(self, row: Tuple) -> bool:
+        with self.lock:
+            if self.rows.get(row[0]) != row:
+                return False
+            self.rows.move_to_end(row[0])
+            return True
+        
+    def update(self, rows: Iterable[Tuple]):
+        with self.lock:
+            for row in rows:
+                self.rows[row[0]] = row
+                self.rows.move_to_end(row[0])
+            while len(self.rows) > self.max_size:
+                self.rows.popitem(last=False)
 
 
 class BatchedRepositoryIngestor:
-    def __init__(self, conn, cursor, batch_size=100):
+    def __init__(self, conn, cursor, batch_size=100, recent: Optional[RecentRepositories] = None):
         self.conn = conn
         self.cursor = cursor
         self.batch_size = batch_size
-        self.buffer = []
+        self.buffer: Dict[int, Tuple] = {} # By id, the last version of a repository wins
+        self.refs: Dict[int, str] = {} # Node ids of repositories that were scraped without their metadata
+        self.recent = recent
+        self.written = 0
+        self.skipped = 0 # Unchanged repositories
+        self.coalesced = 0 # Repositories ingested again before they were flushed
+        self.cached = 0 # Repositories that were just written by the worker
         
     def flush(self):
-        self.buffer.sort(key=lambda row: row[0])
+        # References only add repositories the refresher does not know yet. They are committed on
+        # their own, so that both statements lock their rows in the order of the ids
+        refs = sorted((id, node_id) for id, node_id in self.refs.items() if id not in self.buffer)
         self.cursor.executemany("""
-        INSERT INTO repos (id, name, url, fork, forks, watchers, stars, primary_language)
-        VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
+        INSERT INTO repos (id, node_id)
+        VALUES (%s, %s)
+        ON CONFLICT (id)
+        DO UPDATE SET node_id = EXCLUDED.node_id
+        WHERE repos.node_id IS DISTINCT FROM EXCLUDED.node_id
+        """, refs)
+        self.conn.commit()
+        referenced = max(self.cursor.rowcount, 0)
+        
+        rows = sorted(self.buffer.values(), key=lambda row: row[0])
+        self.cursor.executemany("""
+        INSERT INTO repos (id, name, url, fork, forks, watchers, stars, primary_language, node_id, refreshed_at)
+        VALUES (%s, %s, %s, %s, %s, %s, %s, %s, %s, NOW())
         ON CONFLICT (id)
         DO UPDATE SET 
             id = EXCLUDED.id,
@@ -22,13 +76,31 @@ class BatchedRepositoryIngestor:
             forks = EXCLUDED.forks,
             watchers = EXCLUDED.watchers,
             stars = EXCLUDED.stars,
-            primary_language = EXCLUDED.primary_language
-        """, self.buffer)
+            primary_language = EXCLUDED.primary_language,
+            node_id = COALESCE(EXCLUDED.node_id, repos.node_id),
+            refreshed_at = NOW()
+        WHERE (repos.name, repos.url, repos.fork, repos.forks, repos.watchers, repos.stars, repos.primary_language)
+            IS DISTINCT FROM (EXCLUDED.name, EXCLUDED.url, EXCLUDED.fork, EXCLUDED.forks, EXCLUDED.watchers, EXCLUDED.stars, EXCLUDED.primary_language)
+        """, rows)
         self.conn.commit()
-        self.buffer = []
+        
+        if self.recent is not None:
+            self.recent.update(refs)
+            self.recent.update(rows)
+        
+        written = max(self.cursor.rowcount, 0) + referenced
+        self.written += written
+        self.skipped += len(rows) + len(refs) - written
+        
+        logging.info(f"📊 Ingested {len(rows)} repositories and {len(refs)} references into db ({written} written, {len(rows) + len(refs) - written} unchanged).")
+        self.buffer = {}
+        self.refs = {}
+        
+    def stats(self) -> Dict[str, int]:
+        return {'written': self.written, 'skipped': self.skipped, 'coalesced': self.coalesced, 'cached': self.cached}
     
     def ingest(self, repo: Repository):
-        self.buffer.append((
+        row = (
             repo.id,
             repo.name,
             repo.url,
@@ -36,10 +108,29 @@ class BatchedRepositoryIngestor:
             repo.forks,
             repo.watchers,
             repo.stargazers,
-            repo.primary_language
-        ))
+            repo.primary_language,
+            repo.node_id
+        )
         
-        if len(self.buffer) >= self.batch_size:
+        if self.recent is not None and self.recent.unchanged(row):
+            self.cached += 1
+            return
+        
+        if row[0] in self.buffer:
+            self.coalesced += 1
+        self.buffer[row[0]] = row
+        
+        if len(self.buffer) + len(self.refs) >= self.batch_size:
             self.flush()
+            
+    def ingest_ref(self, ref: RepositoryRef):
+        if self.recent is not None and self.recent.unchanged((ref.id, ref.node_id)):
+            self.cached += 1
+            return
         
-   
\ No newline at end of file
+        if ref.id in self.refs:
+            self.coalesced += 1
+        self.refs[ref.id] = ref.node_id
+        
+        if len(self.buffer) + len(self.refs) >= self.batch_size:
+            self.flush()
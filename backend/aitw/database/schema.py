@@ -0,0 +1,188 @@
+from aitw.database.connection import connect
+
+# Idempotent statements that create the backend tables and bring existing ones up to date.
+# They are applied in order, new migrations are appended at the end.
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS prs (
+        id               BIGINT PRIMARY KEY,
+        agent            TEXT,
+        url              TEXT,
+        title            TEXT,
+        description      TEXT,
+        created_at       TIMESTAMP,
+        closed_at        TIMESTAMP,
+        merged           BOOLEAN,
+        is_draft         BOOLEAN,
+        additions        INT,
+        deletions        INT,
+        changed_files    INT,
+        comments         INT,
+        commits          INT,
+        reviewers        INT,
+        base_repo_id     BIGINT,
+        head_repo_id     BIGINT,
+        base_ref         TEXT,
+        head_ref         TEXT,
+        author_login     TEXT,
+        author_type      TEXT,
+        files            JSONB,
+        commits_list     JSONB,
+        comments_list    JSONB,
+        primary_language TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS repos (
+        id               BIGINT PRIMARY KEY,
+        name             TEXT,
+        url              TEXT,
+        fork             BOOLEAN,
+        forks            INT,
+        watchers         INT,
+        stars            INT,
+        primary_language TEXT
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS jobs (
+        id            SERIAL PRIMARY KEY,
+        start         TIMESTAMP NOT NULL,
+        "end"         TIMESTAMP NOT NULL,
+        query         TEXT NOT NULL DEFAULT '',
+        "group"       TEXT NOT NULL,
+        time_key      TEXT NOT NULL DEFAULT 'created',
+        status        TEXT NOT NULL DEFAULT 'open',
+        failure_count INT NOT NULL DEFAULT 0,
+        started_at    TIMESTAMP,
+        created_at    TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """,
+    # Incremental sync (scrape_manager.sync)
+    """
+    ALTER TABLE prs ADD COLUMN IF NOT EXISTS updated_at TIMESTAMP
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS watermarks (
+        "group"    TEXT PRIMARY KEY,
+        time_key   TEXT NOT NULL,
+        watermark  TIMESTAMP NOT NULL,
+        updated_at TIMESTAMP NOT NULL DEFAULT NOW()
+    )
+    """,
+    # Resumable jobs (aitw.scrape.job.save_checkpoint)
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS checkpoint JSONB
+    """,
+    # Leases (aitw.scrape.job.lease_jobs)
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS heartbeat_at TIMESTAMP
+    """,
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS leased_by TEXT
+    """,
+    # Priorities and fair share (aitw.scrape.job.lease_jobs)
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS priority INT NOT NULL DEFAULT 0
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS job_groups (
+        "group"   TEXT PRIMARY KEY,
+        weight    REAL NOT NULL DEFAULT 1 CHECK (weight > 0),
+        leased_at TIMESTAMP
+    )
+    """,
+    """
+    INSERT INTO job_groups ("group", weight)
+    VALUES ('update', 10), ('sync', 10), ('backfill', 1)
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    INSERT INTO job_groups ("group")
+    SELECT DISTINCT "group" FROM jobs
+    ON CONFLICT DO NOTHING
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_open_idx ON jobs ("group", priority DESC, created_at) WHERE status = 'open'
+    """,
+    # Retries and quarantine (aitw.scrape.job.mark_job_failed)
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS not_before TIMESTAMP
+    """,
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS last_error TEXT
+    """,
+    # Leases of crashed workers (aitw.scrape.job.expire_leases), not counted as failures of the job
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS expired_leases INT NOT NULL DEFAULT 0
+    """,
+    # Density of pull requests over time (aitw.scrape.planner)
+    """
+    CREATE INDEX IF NOT EXISTS prs_created_at_idx ON prs (created_at)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS prs_closed_at_idx ON prs (closed_at)
+    """,
+    # Indexes for each access pattern of the queue, compaction of done jobs (aitw.scrape.job.compact_jobs)
+    """
+    ALTER TABLE jobs ADD COLUMN IF NOT EXISTS finished_at TIMESTAMP
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_group_status_idx ON jobs ("group", status)
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_group_end_idx ON jobs ("group", "end")
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_running_idx ON jobs (COALESCE(heartbeat_at, started_at)) WHERE status = 'running'
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS jobs_failed_idx ON jobs (id) WHERE status IN ('failed', 'quarantined')
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS jobs_summary (
+        "group"      TEXT NOT NULL,
+        time_key     TEXT NOT NULL,
+        day          DATE NOT NULL,
+        jobs         INT NOT NULL,
+        failures     INT NOT NULL,
+        first_start  TIMESTAMP NOT NULL,
+        last_end     TIMESTAMP NOT NULL,
+        compacted_at TIMESTAMP NOT NULL DEFAULT NOW(),
+        PRIMARY KEY ("group", time_key, day)
+    )
+    """,
+    # Every job is updated a few times, dead rows are cleaned up long before the default 20% of the table
+    """
+    ALTER TABLE jobs SET (autovacuum_vacuum_scale_factor = 0.02, autovacuum_analyze_scale_factor = 0.02)
+    """,
+    # Change detection (aitw.database.pull_request_ingestor.content_hash)
+    """
+    ALTER TABLE prs ADD COLUMN IF NOT EXISTS content_hash BYTEA
+    """,
+    # Repository metadata refresher (aitw.scrape.repos)
+    """
+    ALTER TABLE repos ADD COLUMN IF NOT EXISTS node_id TEXT
+    """,
+    """
+    ALTER TABLE repos ADD COLUMN IF NOT EXISTS refreshed_at TIMESTAMP
+    """,
+    """
+    CREATE INDEX IF NOT EXISTS repos_refreshed_at_idx ON repos (refreshed_at NULLS FIRST)
+    """,
+]
+
+
+def migrate(conn):
+    with conn.cursor() as cursor:
+        for statement in SCHEMA:
+            cursor.execute(statement)
+    conn.commit()
+
+
+def migrate_db(conninfo):
+    conn = connect(conninfo)
+    migrate(conn)
+    conn.close()
+
+    print(f"✅ Applied {len(SCHEMA)} schema statements")
@@ -1,5 +1,6 @@
 from typing import Dict
 from aitw.database.connection import connect
+from aitw.database.repository import WITH_METADATA
 from aitw.insights.binned import BinnedPRInsight
 from aitw.insights.language import LanguageInsight
 from aitw.insights.overview import OverviewInsight
@@ -29,6 +30,7 @@ def insights(insight, backend_conninfo, frontend_conninfo):
             backend_conn,
             frontend_conn,
             key="repos.stars",
+            filter=WITH_METADATA,
             bins=[
                 (9, "<10"),
                 (20, "10-20"),
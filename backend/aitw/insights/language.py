@@ -1,3 +1,4 @@
+from aitw.database.repository import WITH_METADATA
 from aitw.insights.binned import BinnedPRInsight
 
 
@@ -38,5 +39,6 @@ class LanguageInsight(BinnedPRInsight):
                 ELSE 1000
             END 
             """,
+            filter=WITH_METADATA,
             remove_uncertain=False,
         )
@@ -0,0 +1,154 @@
+import asyncio
+import logging
+import time
+
+from typing import AsyncIterator, Generator, List, Optional, Tuple
+
+import httpx
+
+from aitw.scrape.page_size import PageSizeController
+from aitw.scrape.queries import COUNT_QUERY
+from aitw.scrape.scraper import T, GitHubScraper, GraphQLRequest, GraphQLResponse, ScrapedObject, ScrapeState
+from aitw.scrape.token_pool import TokenPool
+
+
+class AsyncGitHubScraper(GitHubScraper):
+    """
+    Async variant of the GitHubScraper built on a pooled httpx client.
+
+    It shares the query building, pagination and parsing with the sync scraper and only replaces the
+    transport, so several search pages or time windows can be in flight from a single process.
+    """
+    max_connections = 10
+
+    def __init__(self, token: str | TokenPool, time_key='created', client: Optional[httpx.AsyncClient] = None, profile='full',
+                 page_size: Optional[PageSizeController] = None):
+        super().__init__(token, time_key=time_key, profile=profile, page_size=page_size)
+        self.owns_client = client is None
+        self.client = client or httpx.AsyncClient(
+            timeout=self.timeout,
+            limits=httpx.Limits(max_connections=self.max_connections, max_keepalive_connections=self.max_connections),
+        )
+
+    async def aclose(self):
+        if self.owns_client:
+            await self.client.aclose()
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.aclose()
+
+    async def async_request_and_backoff(self, request: GraphQLRequest) -> GraphQLResponse:
+        backoff = 1
+        while True:
+            token, wait = self.tokens.acquire()
+            if wait > 0:
+                logging.info(f'🐢 Pacing {token.name} for {wait:.1f}s')
+                await asyncio.sleep(wait)
+
+            try:
+                logging.info(f'👉 Request: {request.metadata or ""}')
+
+                start_req_time = time.time()
+                response = await self.client.post(self.url, json=request.payload(), headers=self.headers(token))
+                result = self.handle_response(token, response, time.time() - start_req_time, request)
+                if result is not None:
+                    return result
+
+                reset_in, retry_after = self.retry_hints(response)
+                if reset_in > 0:
+                    self.tokens.exhausted(token, time.time() + reset_in)
+                    continue
+
+                if retry_after is not None:
+                    self.tokens.delay(token, retry_after)
+                    backoff = max(backoff, retry_after)
+
+            except httpx.TimeoutException:
+                logging.info("❌ httpx.TimeoutException")
+            except httpx.TransportError as ex:
+                logging.info(f"❌ httpx.TransportError {type(ex).__name__}")
+
+            if backoff > 300:
+                raise TimeoutError()
+
+            logging.info(f'⏳ Retrying in {backoff}s')
+            await asyncio.sleep(backoff)
+            backoff *= 2
+
+    async def async_count(self, start_date: str, end_date: str, filter: str):
+        query = self.search_query(filter=filter, start_date=start_date, end_date=end_date)
+
+        response = await self.async_request_and_backoff(GraphQLRequest(COUNT_QUERY, {"query": query}))
+        return response.data["search"]["issueCount"]
+
+    async def async_scrape(self, start_date: str, end_date: str, filter: str, state: Optional[ScrapeState] = None) -> AsyncIterator[ScrapedObject]:
+        """Async counterpart of GitHubScraper.scrape, resumes from the state of an interrupted scrape in the same way."""
+        self.state = state or ScrapeState(windows=[(start_date, end_date)])
+        async for obj in self.async_drive(self.scrape_steps(start_date=start_date, end_date=end_date, filter=filter, state=self.state)):
+            yield obj
+
+    async def async_scrape_batched(self, windows: List[Tuple[str, str, str]]) -> AsyncIterator[Tuple[int, ScrapedObject]]:
+        self.states = [ScrapeState(windows=[(start_date, end_date)]) for start_date, end_date, _ in windows]
+        async for obj in self.async_drive(self.batched_scrape_steps([filter for _, _, filter in windows], self.states)):
+            yield obj
+
+    async def async_drive(self, steps: Generator[GraphQLRequest | T, GraphQLResponse, None]) -> AsyncIterator[T]:
+        try:
+            step = next(steps)
+            while True:
+                if isinstance(step, GraphQLRequest):
+                    try:
+                        response = await self.async_request_and_backoff(step)
+                    except Exception as ex:
+                        step = steps.throw(ex)
+                    else:
+                        step = steps.send(response)
+                else:
+                    yield step
+                    step = next(steps)
+        except StopIteration:
+            return
+
+    async def scrape_windows(self, windows: List[Tuple[str, str, str]], concurrency: int = 4,
+                             states: Optional[List[Optional[ScrapeState]]] = None) -> AsyncIterator[Tuple[int, ScrapedObject]]:
+        """
+        Scrapes several (start_date, end_date, filter) windows with up to `concurrency` of them in flight.
+        Yields (window index, object) pairs in the order they arrive. Like scrape_batched, the state of
+        every window is kept in self.states (pass them in to resume).
+        """
+        self.states = [
+            (states[i] if states is not None else None) or ScrapeState(windows=[(start_date, end_date)])
+            for i, (start_date, end_date, _) in enumerate(windows)
+        ]
+        queue: asyncio.Queue = asyncio.Queue(maxsize=concurrency * self.batch_size)
+        semaphore = asyncio.Semaphore(concurrency)
+        done = object()
+
+        async def run(index: int, start_date: str, end_date: str, filter: str):
+            try:
+                async with semaphore:
+                    steps = self.scrape_steps(start_date=start_date, end_date=end_date, filter=filter, state=self.states[index])
+                    async for obj in self.async_drive(steps):
+                        await queue.put((index, obj))
+                await queue.put((index, done))
+            except Exception as ex:
+                await queue.put((index, ex))
+
+        tasks = [asyncio.create_task(run(i, *window)) for i, window in enumerate(windows)]
+        try:
+            remaining = len(tasks)
+            while remaining > 0:
+                index, obj = await queue.get()
+                if obj is done:
+                    remaining -= 1
+                elif isinstance(obj, Exception):
+                    raise obj
+                else:
+                    yield index, obj
+        finally:
+            for task in tasks:
+                task.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
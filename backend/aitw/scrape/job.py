@@ -1,9 +1,58 @@
+import json
+import logging
+import threading
+import time
 
+from collections import Counter
 from dataclasses import dataclass
 from datetime import datetime
-from typing import List, Optional
+from typing import Any, Dict, List, Optional, Set, Tuple
 
-from aitw.database.connection import connect
+import psycopg
+from psycopg.types.json import Jsonb
+
+from aitw.database.connection import connect, connection
+
+HEARTBEAT_INTERVAL = 15 # Seconds between heartbeats of a worker
+LEASE_TIMEOUT = 45 # Seconds without a heartbeat after which a running job is handed to another worker
+AGING_PERIOD = 600 # Seconds of waiting after which the weight of a group in the fair share has doubled
+
+MAX_FAILURES = 8 # Failed attempts after which a job is quarantined instead of retried
+RETRY_DELAY = 60 # Seconds before the first retry, doubled with every failure
+MAX_RETRY_DELAY = 6 * 3600
+MAX_ERROR_LENGTH = 10000
+
+COMPACT_AFTER = 24 * 3600 # Seconds after which done jobs are rolled into jobs_summary by compact_jobs
+COMPACT_BATCH = 10000 # Jobs compacted per transaction
+
+# Counts a failed attempt of a job: it is retried after an exponential backoff, or quarantined
+# (until requeued by hand) once it failed MAX_FAILURES times
+RETRY_OR_QUARANTINE = f"""
+    failure_count = failure_count + 1,
+    status = CASE WHEN failure_count + 1 >= {MAX_FAILURES} THEN 'quarantined' ELSE 'open' END,
+    not_before = NOW() + make_interval(secs => LEAST({RETRY_DELAY} * power(2, failure_count), {MAX_RETRY_DELAY})),
+    leased_by = NULL
+"""
+
+# Only the worker holding the lease of a running job may finish it, a worker whose lease expired
+# must not touch the job once it was handed to another worker
+HELD_LEASE = "status = 'running' AND leased_by IS NOT DISTINCT FROM %s"
+
+# Job submissions and status changes are announced on this channel with a JSON payload
+# {"event": "submitted" | "done" | "failed" | "reopened" | "deleted", "group": ..., "count": ...}
+JOBS_CHANNEL = 'jobs'
+
+def notifying(update: str, event: str) -> str:
+    """
+    Wraps an UPDATE/DELETE ... RETURNING "group" statement so that it announces the number of
+    affected jobs per group (when the transaction commits) and returns (group, count) rows.
+    """
+    return f"""
+        WITH affected AS ({update})
+        SELECT "group", COUNT(*), pg_notify('{JOBS_CHANNEL}', json_build_object('event', '{event}', 'group', "group", 'count', COUNT(*))::text)
+        FROM affected
+        GROUP BY "group"
+    """
 
 
 @dataclass
@@ -20,6 +69,9 @@ class ScrapeJob:
     failure_count: int
     started_at: str
     
+    checkpoint: Optional[Dict[str, Any]] = None # Progress of a previous attempt, see save_checkpoint
+    leased_by: Optional[str] = None # Worker holding the lease of a running job
+    
 @dataclass 
 class CreateScrapeJob:
     group: str
@@ -27,6 +79,14 @@ class CreateScrapeJob:
     to_date: datetime
     query: str
     time_key: str
+    priority: int = 0 # Jobs with a higher priority run first within their group
+    
+@dataclass
+class GroupShare:
+    group: str
+    weight: float # Share of the running jobs the group is entitled to (relative to the other groups)
+    running: int
+    waiting: float # Seconds the group has been waiting for a worker (since its last lease or its next job was submitted)
     
 class JobManager():
     
@@ -38,71 +98,342 @@ class JobManager():
         
     def delete_all(self, group: str):
         with self.conn.cursor() as cur:
+            cur.execute(notifying("""
+                DELETE FROM jobs WHERE "group" = %s RETURNING "group"
+            """, 'deleted'), (group,))
             cur.execute("""
-                DELETE FROM jobs WHERE "group" = %s
+                DELETE FROM jobs_summary WHERE "group" = %s
             """, (group,))
         self.conn.commit()
         
-    def create_jobs(self, list: List[CreateScrapeJob]):
+    def create_jobs(self, list: List[CreateScrapeJob], watermark: Optional[datetime] = None):
+        """
+        Submits the jobs. If a watermark is given, the high-water mark of their group is advanced to
+        it in the same transaction, so windows are never submitted twice or skipped.
+        """
         with self.conn.cursor() as cur:
+            # A backfill submits hundreds of thousands of jobs, COPY streams them in a single statement
+            with cur.copy("""
+                COPY jobs (start, "end", query, "group", time_key, priority) FROM STDIN
+            """) as copy:
+                for c in list:
+                    copy.write_row((c.from_date, c.to_date, c.query, c.group, c.time_key, c.priority))
+            
+            # New groups take part in the fair share with the default weight
             cur.executemany("""
-                INSERT INTO jobs (start, "end", query, "group", time_key)
-                VALUES (%s, %s, %s, %s, %s)
-            """, [(c.from_date, c.to_date, c.query, c.group, c.time_key) for c in list])
+                INSERT INTO job_groups ("group") VALUES (%s) ON CONFLICT DO NOTHING
+            """, [(group,) for group in sorted({c.group for c in list})])
+            
+            if watermark is not None and len(list) > 0:
+                cur.execute("""
+                    INSERT INTO watermarks ("group", time_key, watermark)
+                    VALUES (%s, %s, %s)
+                    ON CONFLICT ("group")
+                    DO UPDATE SET time_key = EXCLUDED.time_key, watermark = EXCLUDED.watermark, updated_at = NOW()
+                """, (list[0].group, list[0].time_key, watermark))
+            
+            # Wakes up idle workers once the jobs are committed
+            for group, count in Counter(c.group for c in list).items():
+                cur.execute("SELECT pg_notify(%s, %s)", (JOBS_CHANNEL, json.dumps({'event': 'submitted', 'group': group, 'count': count})))
+        self.conn.commit()
+        
+    def set_weight(self, group: str, weight: float):
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO job_groups ("group", weight) VALUES (%s, %s)
+                ON CONFLICT ("group") DO UPDATE SET weight = EXCLUDED.weight
+            """, (group, weight))
         self.conn.commit()
+        
+    def watermark(self, group: str) -> Optional[datetime]:
+        """End of the last window submitted for the group by an incremental sync."""
+        with self.conn.cursor() as cur:
+            cur.execute("""
+                SELECT watermark FROM watermarks WHERE "group" = %s
+            """, (group,))
+            row = cur.fetchone()
+        self.conn.commit()
+        
+        return row[0] if row is not None else None
 
     
-def pick_job(conninfo, group: str | None) -> Optional[ScrapeJob]:
-    conn = connect(conninfo)
-    with conn.cursor() as cur:
-        cur.execute(f"""
+def allocate(groups: List[GroupShare], slots: int) -> Dict[str, int]:
+    """
+    Fair share: hands out the slots one by one to the group with the fewest running (and already
+    allocated) jobs relative to its weight. The weight of a group grows with the time it has been
+    waiting for a worker, so that groups with a low weight are slowed down but never stall.
+    """
+    allocation = {share.group: 0 for share in groups}
+    effective_weights = {share.group: share.weight * (1 + share.waiting / AGING_PERIOD) for share in groups}
+    
+    for _ in range(slots if len(groups) > 0 else 0):
+        share = min(groups, key=lambda share: ((share.running + allocation[share.group]) / effective_weights[share.group], -share.waiting))
+        allocation[share.group] += 1
+    return allocation
+
+def lease_jobs(conninfo, group: str | None, limit: int, worker_id: Optional[str] = None) -> List[ScrapeJob]:
+    """
+    Claims up to `limit` open jobs, shared between the groups with open jobs by allocate() and in
+    the order of their priority (then submission) within a group. The lease of a job expires unless
+    the worker sends heartbeats (see Heartbeat), then expire_leases hands the job to another worker.
+    """
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT * FROM (
+                SELECT
+                    g."group",
+                    g.weight,
+                    (SELECT COUNT(*) FROM jobs j WHERE j.status = 'running' AND j."group" = g."group"),
+                    (
+                        SELECT EXTRACT(EPOCH FROM NOW() - GREATEST(j.created_at, g.leased_at))::float
+                        FROM jobs j
+                        WHERE j.status = 'open' AND j."group" = g."group" AND (j.not_before IS NULL OR j.not_before <= NOW())
+                        ORDER BY j.priority DESC, j.created_at
+                        LIMIT 1
+                    ) AS waiting
+                FROM job_groups g
+                WHERE %(group)s::text IS NULL OR g."group" = %(group)s
+            ) AS shares
+            WHERE waiting IS NOT NULL
+        """, {'group': group or None})
+        shares = [GroupShare(group=row[0], weight=row[1], running=row[2], waiting=max(row[3], 0)) for row in cur.fetchall()]
+        
+        rows = []
+        for share_group, count in allocate(shares, limit).items():
+            if count > 0:
+                rows += lease_from_group(cur, share_group, count, worker_id)
+        
+        # Slots of groups that ran out of open jobs (or whose jobs are leased concurrently)
+        for share in sorted(shares, key=lambda share: -share.weight):
+            if len(rows) >= limit:
+                break
+            rows += lease_from_group(cur, share.group, limit - len(rows), worker_id)
+        
+        # Group rows are locked once and in a fixed order, so concurrent leases cannot deadlock on them
+        leased_groups = sorted({row[1] for row in rows})
+        if len(leased_groups) > 0:
+            cur.execute("""
+                UPDATE job_groups SET leased_at = NOW()
+                WHERE "group" IN (SELECT "group" FROM job_groups WHERE "group" = ANY(%s) ORDER BY "group" FOR UPDATE)
+            """, (leased_groups,))
+    
+    return [
+        ScrapeJob(
+            id=res[0],
+            group=res[1],
+            status=res[2],
+            from_date=res[3],
+            to_date=res[4],
+            query=res[5],
+            started_at=res[6],
+            failure_count=res[7],
+            time_key=res[8],
+            checkpoint=res[9],
+            leased_by=worker_id
+        )
+        for res in sorted(rows, key=lambda row: row[0])
+    ]
+    
+def lease_from_group(cur, group: str, limit: int, worker_id: Optional[str]) -> List[Any]:
+    cur.execute("""
+        UPDATE jobs
+        SET status = 'running', started_at = NOW(), heartbeat_at = NOW(), leased_by = %(worker_id)s
+        WHERE id IN (
+            SELECT id
+            FROM jobs
+            WHERE status = 'open' AND "group" = %(group)s AND (not_before IS NULL OR not_before <= NOW())
+            ORDER BY priority DESC, created_at
+            FOR UPDATE SKIP LOCKED
+            LIMIT %(limit)s
+        )
+        RETURNING id, "group", status, start, "end", query, started_at, failure_count, time_key, checkpoint;
+    """, {'group': group, 'limit': limit, 'worker_id': worker_id})
+    return cur.fetchall()
+    
+def heartbeat(conninfo, job_ids: List[int]):
+    """Extends the leases of running jobs."""
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE jobs SET heartbeat_at = NOW() WHERE id = ANY(%s) AND status = 'running'
+        """, (job_ids, ))
+
+def expire_leases(conninfo, timeout: int) -> int:
+    """
+    Reopens running jobs without a heartbeat for `timeout` seconds (their worker crashed or hangs). The job
+    itself did not fail, so it is retried right away and counted in expired_leases instead of failure_count.
+    """
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute(notifying("""
             UPDATE jobs
-            SET status = 'running', started_at = NOW()
-            WHERE id = (
-                SELECT id
-                FROM jobs
-                WHERE status = 'open' {f"""AND "group" = '{group}'""" if group is not None and len(group) > 0 else ''}
-                ORDER BY created_at
-                FOR UPDATE SKIP LOCKED
-                LIMIT 1
-            )
-            RETURNING id, "group", status, start, "end", query, started_at, failure_count, time_key;
-        """)
-        res = cur.fetchone()
-    conn.commit()
-    conn.close()
-        
-    if res is None: 
-        return None
-    
-    job = ScrapeJob(
-        id=res[0],
-        group=res[1],
-        status=res[2],
-        from_date=res[3],
-        to_date=res[4],
-        query=res[5],
-        started_at=res[6],
-        failure_count=res[7],
-        time_key=res[8]
-    )
-        
-    return job
-
-def mark_job_failed(conninfo: str, job: ScrapeJob):
-    conn = connect(conninfo)
-    with conn.cursor() as cur:
+            SET status = 'open', not_before = NULL, leased_by = NULL, expired_leases = expired_leases + 1, last_error = 'Lease expired'
+            WHERE status = 'running' AND COALESCE(heartbeat_at, started_at) < NOW() - make_interval(secs => %s)
+            RETURNING "group"
+        """, 'reopened'), (timeout, ))
+        return sum(count for _, count, _ in cur.fetchall())
+
+class Heartbeat:
+    """Keeps the leases of the jobs a worker is running alive from a background thread."""
+    
+    def __init__(self, conninfo, interval: int = HEARTBEAT_INTERVAL):
+        self.conninfo = conninfo
+        self.interval = interval
+        self.job_ids: Set[int] = set()
+        self.lock = threading.Lock()
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.run, name='heartbeat', daemon=True)
+        
+    def __enter__(self) -> 'Heartbeat':
+        self.thread.start()
+        return self
+    
+    def __exit__(self, *args):
+        self.stopped.set()
+        self.thread.join()
+        
+    def add(self, jobs: List[ScrapeJob]):
+        with self.lock:
+            self.job_ids.update(job.id for job in jobs)
+            
+    def remove(self, jobs: List[ScrapeJob]):
+        with self.lock:
+            self.job_ids.difference_update(job.id for job in jobs)
+    
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            with self.lock:
+                job_ids = sorted(self.job_ids)
+            if len(job_ids) == 0:
+                continue
+            
+            try:
+                heartbeat(self.conninfo, job_ids)
+            except Exception as ex:
+                # The lease survives a few missed heartbeats
+                logging.warning(f'⚠️  Heartbeat for jobs {job_ids} failed: {ex}')
+
+def mark_job_failed(conninfo: str, job: ScrapeJob, error: Optional[str] = None) -> bool:
+    """
+    Schedules the retry of the job (or quarantines it) and keeps the error for inspection. Returns
+    False if the worker lost the lease of the job meanwhile, the job is left to its new holder then.
+    """
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute(notifying(f"""
+            UPDATE jobs SET {RETRY_OR_QUARANTINE}, last_error = %s WHERE id = %s AND {HELD_LEASE} RETURNING "group"
+        """, 'failed'), (error[-MAX_ERROR_LENGTH:] if error is not None else None, job.id, job.leased_by))
+        return len(cur.fetchall()) > 0
+        
+def quarantined_jobs(conninfo, group: Optional[str] = None) -> List[Tuple[ScrapeJob, str]]:
+    """Quarantined jobs (of the group) with their last error."""
+    with connection(conninfo) as conn, conn.cursor() as cur:
         cur.execute("""
-            UPDATE jobs SET status = 'failed' WHERE id = %s
-        """, (job.id, ))
-    conn.commit()
-    conn.close()
+            SELECT id, "group", status, start, "end", query, started_at, failure_count, time_key, last_error
+            FROM jobs
+            WHERE status = 'quarantined' AND (%(group)s::text IS NULL OR "group" = %(group)s)
+            ORDER BY id
+        """, {'group': group})
+        rows = cur.fetchall()
+        
+    return [
+        (ScrapeJob(id=res[0], group=res[1], status=res[2], from_date=res[3], to_date=res[4], query=res[5],
+                   started_at=res[6], failure_count=res[7], time_key=res[8]), res[9])
+        for res in rows
+    ]
 
-def mark_job_done(conninfo: str, job: ScrapeJob):
-    conn = connect(conninfo)
+def requeue_jobs(conninfo, group: Optional[str] = None, ids: Optional[List[int]] = None) -> int:
+    """Reopens quarantined jobs (of the group or with the ids) with a fresh failure count."""
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute(notifying("""
+            UPDATE jobs
+            SET status = 'open', failure_count = 0, not_before = NULL
+            WHERE status = 'quarantined' AND (%(group)s::text IS NULL OR "group" = %(group)s) AND (%(ids)s::int[] IS NULL OR id = ANY(%(ids)s))
+            RETURNING "group"
+        """, 'reopened'), {'group': group, 'ids': ids})
+        return sum(count for _, count, _ in cur.fetchall())
+
+def mark_job_done(conninfo: str, job: ScrapeJob) -> bool:
+    """Marks the job as done. Returns False if the worker lost the lease of the job meanwhile."""
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute(notifying(f"""
+            UPDATE jobs SET status = 'done', checkpoint = NULL, finished_at = NOW() WHERE id = %s AND {HELD_LEASE} RETURNING "group"
+        """, 'done'), (job.id, job.leased_by))
+        return len(cur.fetchall()) > 0
+
+def compact_jobs(conninfo, group: Optional[str] = None, older_than: int = COMPACT_AFTER, batch_size: int = COMPACT_BATCH) -> int:
+    """
+    Rolls the jobs (of the group) that are done for more than `older_than` seconds into jobs_summary,
+    one row per group, time key and day of their windows, and deletes them from the queue. Runs in
+    transactions of `batch_size` jobs next to the workers. Returns the number of compacted jobs.
+    """
+    compacted = 0
+    while True:
+        with connection(conninfo) as conn, conn.cursor() as cur:
+            cur.execute("""
+                WITH compacted AS (
+                    DELETE FROM jobs
+                    WHERE id IN (
+                        SELECT id FROM jobs
+                        WHERE status = 'done' AND (%(group)s::text IS NULL OR "group" = %(group)s)
+                          AND COALESCE(finished_at, started_at, created_at) < NOW() - make_interval(secs => %(older_than)s)
+                        LIMIT %(batch_size)s
+                        FOR UPDATE SKIP LOCKED
+                    )
+                    RETURNING "group", time_key, start, "end", failure_count
+                ), summarized AS (
+                    INSERT INTO jobs_summary ("group", time_key, day, jobs, failures, first_start, last_end)
+                    SELECT "group", time_key, start::date, COUNT(*), SUM(failure_count), MIN(start), MAX("end")
+                    FROM compacted
+                    GROUP BY 1, 2, 3
+                    ON CONFLICT ("group", time_key, day) DO UPDATE SET
+                        jobs = jobs_summary.jobs + EXCLUDED.jobs,
+                        failures = jobs_summary.failures + EXCLUDED.failures,
+                        first_start = LEAST(jobs_summary.first_start, EXCLUDED.first_start),
+                        last_end = GREATEST(jobs_summary.last_end, EXCLUDED.last_end),
+                        compacted_at = NOW()
+                )
+                SELECT COUNT(*) FROM compacted
+            """, {'group': group, 'older_than': older_than, 'batch_size': batch_size})
+            (count, ) = cur.fetchone()
+        
+        compacted += count
+        if count < batch_size:
+            return compacted
+
+def save_checkpoint(conn, job: ScrapeJob, checkpoint: Dict[str, Any]):
+    """
+    Persists the progress of a running job, a retry of the job resumes from it. Takes the connection
+    of the ingestors: everything scraped before the checkpoint has to be flushed first.
+    """
     with conn.cursor() as cur:
-        cur.execute("""
-            UPDATE jobs SET status = 'done' WHERE id = %s
-        """, (job.id, ))
+        cur.execute(f"""
+            UPDATE jobs SET checkpoint = %s WHERE id = %s AND {HELD_LEASE}
+        """, (Jsonb(checkpoint), job.id, job.leased_by))
     conn.commit()
-    conn.close()
+    job.checkpoint = checkpoint
+
+class JobEvents:
+    """
+    Listens to the announcements on JOBS_CHANNEL on a dedicated connection. Postgres keeps every
+    notification until all listeners read it, so only listen while the events are waited for and
+    close it otherwise.
+    """
+    
+    def __init__(self, conninfo):
+        # Notifications are buffered from here on, so nothing gets lost between a query and wait()
+        self.conn = psycopg.connect(conninfo, autocommit=True)
+        self.conn.execute(f"LISTEN {JOBS_CHANNEL}")
+        
+    def close(self):
+        self.conn.close()
+        
+    def wait(self, timeout: float) -> List[Dict[str, Any]]:
+        """Blocks until events arrived (returns all of them) or the timeout passed (returns none)."""
+        return [json.loads(notify.payload) for notify in self.conn.notifies(timeout=timeout, stop_after=1)]
+    
+    def wait_for_jobs(self, group: Optional[str], timeout: float) -> bool:
+        """Blocks until jobs (of the group) were submitted or reopened. Returns False on timeout."""
+        deadline = time.time() + timeout
+        while (remaining := deadline - time.time()) > 0:
+            for event in self.wait(remaining):
+                if event['event'] in ('submitted', 'reopened') and (not group or event['group'] == group):
+                    return True
+        return False
@@ -7,8 +7,13 @@ import time
 import click
 from tqdm import tqdm
 
-from aitw.database.connection import connect
-from aitw.scrape.job import CreateScrapeJob, JobManager
+from aitw.database.connection import connect, connection
+from aitw.scrape.job import (
+    COMPACT_AFTER, HEARTBEAT_INTERVAL, LEASE_TIMEOUT, RETRY_OR_QUARANTINE, CreateScrapeJob, JobEvents, JobManager, compact_jobs,
+    expire_leases, notifying, quarantined_jobs, requeue_jobs
+)
+from aitw.scrape import planner
+from aitw.scrape.planner import TARGET_PRS
 
 DATE_FROMAT = "%Y-%m-%dT%H:%M:%S"
 
@@ -26,15 +31,52 @@ def slice(start, end, slice_size):
     return slices_arr
 
 
-def update(db_conninfo):
-    # TODO find the last update jobs if existent and start from there
+def cover(start, end, slice_size):
+    """Like slice, but with a last, shorter slice for the remainder so that [start, end) is covered exactly."""
+    slices_arr = slice(start, end, slice_size)
+    last_end = slices_arr[-1][1] if len(slices_arr) > 0 else start
+    if last_end < end:
+        slices_arr.append((last_end, end))
+    return slices_arr
+
+
+def plan(db_conninfo, group, time_key, start, end, target=TARGET_PRS, tokens=None, priority=0):
+    """
+    Jobs for [start, end) sized to `target` pull requests each by the estimated density, or one
+    job per minute if there is nothing to estimate it from.
+    """
+    if start >= end:
+        return []
+
+    estimated = planner.estimate(db_conninfo, time_key, start, end, tokens=tokens)
+    if estimated is None:
+        click.echo(f"⚠️  No history of {time_key} pull requests to plan with, falling back to one job per minute")
+        windows = cover(start, end, 60)
+    else:
+        windows = planner.plan_windows(start, end, estimated, target=target)
+        expected = sum(estimated(hour) for hour in planner.hours(start, end))
+        click.echo(f"📐 Planned {len(windows)} {time_key} jobs for about {expected:.0f} pull requests")
+
+    return [
+        # Job ends are inclusive in the search, the next window starts a second later
+        CreateScrapeJob(from_date=window_start, to_date=window_end - timedelta(seconds=1), query="", group=group, time_key=time_key, priority=priority)
+        for window_start, window_end in windows
+    ]
+
+
+def update(db_conninfo, target=TARGET_PRS, tokens=None, priority=0):
     conn = connect(db_conninfo)
     with conn.cursor() as cur:
+            # Compacted jobs only remain in the summary
             cur.execute("""
-                SELECT "end" FROM jobs WHERE "group"='update' ORDER BY "end" DESC LIMIT 1
+                SELECT GREATEST(
+                    (SELECT MAX("end") FROM jobs WHERE "group" = 'update'),
+                    (SELECT MAX(last_end) FROM jobs_summary WHERE "group" = 'update')
+                )
             """)
-            if cur.rowcount > 0:
-                (last_end, ) = cur.fetchone()
+            (last_end, ) = cur.fetchone()
+            if last_end is not None:
+                last_end += timedelta(seconds=1)
             else:
                 last_end = datetime.now(tz=timezone.utc) - timedelta(days=7)
             
@@ -43,97 +85,153 @@ def update(db_conninfo):
     start = last_end.replace(tzinfo=timezone.utc)
     end = (datetime.now(tz=timezone.utc) - timedelta(minutes=15)).replace(second=0, microsecond=0)
 
-    sliced = slice(start, end, 60)
-    
+    jobs = [
+        *plan(db_conninfo, "update", "created", start, end, target=target, tokens=tokens, priority=priority),
+        *plan(db_conninfo, "update", "closed", start, end, target=target, tokens=tokens, priority=priority),
+    ]
+
     job_manager = JobManager(db_conninfo)
+    job_manager.create_jobs(jobs)
+    job_manager.close()
+
+    click.echo(f"✅ Submitted {len(jobs)} jobs")
+
+def sync(db_conninfo, group="sync", window=300, lag=15, since=7, priority=0):
+    """
+    Incremental sync: submits `updated` jobs from the high-water mark of the group up to `lag`
+    minutes ago and advances the mark. Every pull request that was created, closed, merged, pushed
+    to or commented on since the last sync shows up in exactly one window and is fetched once (in
+    full, with its updatedAt). The first sync starts `since` days ago.
+    """
+    job_manager = JobManager(db_conninfo)
+    
+    watermark = job_manager.watermark(group)
+    start = watermark.replace(tzinfo=timezone.utc) if watermark is not None else \
+        (datetime.now(tz=timezone.utc) - timedelta(days=since)).replace(second=0, microsecond=0)
+    # The search index lags behind, windows are only submitted once it caught up
+    end = (datetime.now(tz=timezone.utc) - timedelta(minutes=lag)).replace(second=0, microsecond=0)
+    
+    # Windows are larger than the one minute of the update group: dense windows are split by the
+    # scraper, so sparse minutes do not cost a request each
+    sliced = slice(start, end, window)
+    
     job_manager.create_jobs(
         [
-            CreateScrapeJob(
-                from_date=start,
-                to_date=end,
-                query="",
-                group="update",
-                time_key="created"
-            )
-            for start, end in sliced
-        ]
-    )
-    job_manager.create_jobs(
-        [
-            CreateScrapeJob(
-                from_date=start,
-                to_date=end,
-                query="",
-                group="update",
-                time_key="closed"
-            )
+            # Search ranges are inclusive, the last second belongs to the next window
+            CreateScrapeJob(from_date=start, to_date=end - timedelta(seconds=1), query="", group=group, time_key="updated", priority=priority)
             for start, end in sliced
-        ]
+        ],
+        watermark=sliced[-1][1] if len(sliced) > 0 else None,
     )
     job_manager.close()
+    
+    if len(sliced) > 0:
+        click.echo(f"✅ Submitted {len(sliced)} jobs, {group} is synced until {sliced[-1][1]}")
+    else:
+        click.echo(f"ℹ️  {group} is already synced until {start}")
 
-    click.echo(f"✅ Submitted {2*len(sliced)} jobs")
-
-def backfill(db_conninfo):
+def backfill(db_conninfo, target=TARGET_PRS, tokens=None, priority=0):
     start = datetime.strptime("2025-05-15T00:00:00", DATE_FROMAT).replace(tzinfo=timezone.utc)
-    end = (datetime.now(tz=timezone.utc))
+    end = (datetime.now(tz=timezone.utc)).replace(microsecond=0)
 
-    sliced = slice(start, end, 60)
+    jobs = plan(db_conninfo, "backfill", "created", start, end, target=target, tokens=tokens, priority=priority)
 
     job_manager = JobManager(db_conninfo)
     job_manager.delete_all("backfill")
-    job_manager.create_jobs(
-        [
-            CreateScrapeJob(from_date=start, to_date=end, query="", group="backfill", time_key="created")
-            for start, end in sliced
-        ]
-    )
+    job_manager.create_jobs(jobs)
     job_manager.close()
 
-    click.echo(f"✅ Submitted {len(sliced)} jobs")
+    click.echo(f"✅ Submitted {len(jobs)} jobs")
 
 
-def stats(group, db_conninfo):
-    conn = connect(db_conninfo)
+def stats(group, db_conninfo, resync_interval=60):
+    """Shows the progress of the group, updated from the job events instead of polling the jobs table."""
+    events = JobEvents(db_conninfo)
     
-    with conn.cursor() as cur:
-        def total():
-            cur.execute('SELECT COUNT(*) FROM jobs WHERE "group" = %s', (group,))
-            return cur.fetchone()[0]
-        
-        def done():
-            cur.execute('SELECT COUNT(*) FROM jobs WHERE status=\'done\' AND "group" = %s', (group,))
-            return cur.fetchone()[0]
-        
-        bar = tqdm(total=total(),initial=done(),smoothing=0.0)
-        
-        while True:
-            bar.update(done() - bar.n)   
-            time.sleep(.5)
+    def counts():
+        with connection(db_conninfo) as conn, conn.cursor() as cur:
+            # Compacted jobs are done
+            cur.execute("""
+                SELECT
+                    (SELECT COUNT(*) FROM jobs WHERE "group" = %(group)s) + compacted,
+                    (SELECT COUNT(*) FROM jobs WHERE "group" = %(group)s AND status = 'done') + compacted
+                FROM (SELECT COALESCE(SUM(jobs), 0) AS compacted FROM jobs_summary WHERE "group" = %(group)s) AS summary
+            """, {'group': group})
+            return cur.fetchone()
+    
+    total, done = counts()
+    bar = tqdm(total=total, initial=done, smoothing=0.0)
+    
+    last_sync = time.time()
+    while True:
+        resync = time.time() - last_sync > resync_interval
+        for event in events.wait(timeout=resync_interval):
+            if event['group'] != group:
+                continue
+            
+            if event['event'] == 'submitted':
+                bar.total += event['count']
+                bar.refresh()
+            elif event['event'] == 'done':
+                bar.update(event['count'])
+            elif event['event'] == 'deleted':
+                resync = True
         
-    conn.close()
+        # Counting now and then corrects for changes that were not announced
+        if resync:
+            total, done = counts()
+            bar.total = total
+            bar.update(done - bar.n)
+            last_sync = time.time()
+
+
+def weight(group, weight, db_conninfo):
+    job_manager = JobManager(db_conninfo)
+    job_manager.set_weight(group, weight)
+    job_manager.close()
+    
+    click.echo(f"✅ {group} has a weight of {weight} in the fair share")
+
+
+def quarantined(group, db_conninfo):
+    jobs = quarantined_jobs(db_conninfo, group)
+    for job, error in jobs:
+        last_line = error.strip().splitlines()[-1] if error else ''
+        click.echo(f"{job.id}\t{job.group}\t{job.time_key}\t{job.from_date}..{job.to_date}\t{job.failure_count} failures\t{last_line}")
+    
+    click.echo(f"ℹ️  {len(jobs)} jobs are quarantined")
+
+
+def requeue(group, ids, db_conninfo):
+    count = requeue_jobs(db_conninfo, group, list(ids) if ids else None)
+    click.echo(f"✅ Requeued {count} quarantined jobs")
+
+
+def compact(group, db_conninfo, older_than=COMPACT_AFTER):
+    count = compact_jobs(db_conninfo, group, older_than=older_than)
+    click.echo(f"✅ Compacted {count} done jobs into the summary")
 
 
 def monitor(db_conninfo):
     print('👀 Monitoring jobs...')
     
     while True:
-        conn = connect(db_conninfo)
-        with conn.cursor() as cursor:
-            cursor.execute("""
+        # Failed jobs schedule their own retries, this only picks up jobs that failed before
+        with connection(db_conninfo) as conn, conn.cursor() as cursor:
+            cursor.execute(notifying(f"""
                 UPDATE jobs
-                SET status = 'open', failure_count = failure_count + 1
-                WHERE status = 'failed' OR (status = 'running' AND started_at < NOW() - interval '1h' AND failure_count < 10)
-                RETURNING *;
-            """)
-            resetted = cursor.fetchall()
+                SET {RETRY_OR_QUARANTINE}
+                WHERE status = 'failed'
+                RETURNING "group"
+            """, 'reopened'))
+            resetted = sum(count for _, count, _ in cursor.fetchall())
         
-        conn.commit()
-        conn.close()
+        if resetted > 0:
+            print(f'⚠️ Scheduled the retry of {resetted} jobs that failed.')
         
-        if len(resetted) > 0:
-            print(f'⚠️ Reset {len(resetted)} jobs that were either stuck or failed.')
+        # Jobs of crashed (or hanging) workers come back as soon as their lease expired
+        expired = expire_leases(db_conninfo, LEASE_TIMEOUT)
+        if expired > 0:
+            print(f'⚠️ Reset {expired} jobs whose lease expired.')
             
-        time.sleep(60)
-
-
+        time.sleep(HEARTBEAT_INTERVAL)
@@ -0,0 +1,57 @@
+import threading
+
+from typing import Any, Dict
+
+
+class PageSizeController:
+    """
+    Learns the number of search results to request per page (AIMD).
+
+    Fast and cheap pages increase the page size additively, timeouts (and 5xx errors) halve it and
+    pages slower than the target latency shrink it slightly. Unlike resetting to a fixed size after
+    every page, the controller does not walk straight back into the timeout of a heavy window.
+    Controllers are thread-safe and can be shared by the scrapers of a worker.
+    """
+    increase = 5
+    decrease = 0.5
+    slow_decrease = 0.8
+    target_latency = 8.0 # Seconds, GitHub aborts searches that take more than ~10s with a 502
+    max_cost = 100 # Rate limit points per request
+    smoothing = 0.2
+
+    def __init__(self, initial: int = 25, min_size: int = 1, max_size: int = 100):
+        self.size = initial
+        self.min_size = min_size
+        self.max_size = max_size
+
+        self.successes = 0
+        self.failures = 0
+        self.latency = 0.0 # Exponentially smoothed
+        self.lock = threading.Lock()
+
+    def success(self, elapsed: float, cost: int):
+        with self.lock:
+            self.successes += 1
+            self.latency = elapsed if self.successes == 1 else (1 - self.smoothing) * self.latency + self.smoothing * elapsed
+
+            if elapsed > self.target_latency or cost > self.max_cost:
+                self.size = max(self.min_size, int(self.size * self.slow_decrease))
+            else:
+                self.size = min(self.max_size, self.size + self.increase)
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            self.size = max(self.min_size, int(self.size * self.decrease))
+
+    def stats(self) -> Dict[str, Any]:
+        with self.lock:
+            return {
+                'page_size': self.size,
+                'successes': self.successes,
+                'failures': self.failures,
+                'latency_ms': round(self.latency * 1000),
+            }
+
+    def __repr__(self):
+        return f'PageSizeController({self.stats()})'
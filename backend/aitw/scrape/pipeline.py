@@ -0,0 +1,108 @@
+import logging
+import queue
+import threading
+
+from typing import Any, Callable, Iterable, Iterator, List, Optional
+
+END = object() # Sent downstream once a stage is done
+
+
+class Pipeline:
+    """
+    Runs a source iterator and a chain of stages on their own threads, connected by bounded queues,
+    and yields the output of the last stage to the calling thread. While the caller is busy (e.g.
+    writing to the database) the source keeps fetching until the queues are full.
+
+    An exception in any stage (or in the caller) stops all of them and is re-raised to the caller.
+    Use it as a context manager so the threads are shut down when the caller stops early.
+    """
+    poll_interval = 0.1
+    source_shutdown_timeout = 5 # Seconds, a source blocked in a request is left to stop on its own
+
+    def __init__(self, source: Iterable[Any], stages: List[Callable[[Any], Any]], maxsize=1000):
+        self.source = source
+        self.stages = stages
+        self.queues: List[queue.Queue] = [queue.Queue(maxsize=maxsize) for _ in range(len(stages) + 1)]
+        self.stopped = threading.Event()
+        self.error: Optional[BaseException] = None
+
+        self.source_thread = threading.Thread(target=self.run_source, name='pipeline-source', daemon=True)
+        self.stage_threads = [
+            threading.Thread(target=self.run_stage, args=(i,), name=f'pipeline-stage-{i}', daemon=True)
+            for i in range(len(stages))
+        ]
+
+    def __enter__(self) -> 'Pipeline':
+        self.source_thread.start()
+        for thread in self.stage_threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def __iter__(self) -> Iterator[Any]:
+        while (item := self.get(self.queues[-1])) is not END:
+            yield item
+
+        if self.error is not None:
+            raise self.error
+
+    def close(self):
+        self.stopped.set()
+        for thread in self.stage_threads:
+            thread.join()
+
+        self.source_thread.join(timeout=self.source_shutdown_timeout)
+        if self.source_thread.is_alive():
+            logging.warning('⚠️  Pipeline source is still busy, leaving it to stop after its current item')
+
+    def fail(self, ex: BaseException):
+        if self.error is None:
+            self.error = ex
+        self.stopped.set()
+
+    def put(self, q: queue.Queue, item: Any) -> bool:
+        """Blocks while the queue is full (backpressure). Returns False if the pipeline stopped."""
+        while not self.stopped.is_set():
+            try:
+                q.put(item, timeout=self.poll_interval)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def get(self, q: queue.Queue) -> Any:
+        """Blocks until an item is available. Returns END if the pipeline stopped."""
+        while not self.stopped.is_set():
+            try:
+                return q.get(timeout=self.poll_interval)
+            except queue.Empty:
+                continue
+        return END
+
+    def run_source(self):
+        iterator = iter(self.source)
+        try:
+            for item in iterator:
+                if not self.put(self.queues[0], item):
+                    break
+            else:
+                self.put(self.queues[0], END)
+        except BaseException as ex:
+            self.fail(ex)
+        finally:
+            # Closes generators (and their connections) on the thread that iterated them
+            close = getattr(iterator, 'close', None)
+            if close is not None:
+                close()
+
+    def run_stage(self, index: int):
+        stage, inbox, outbox = self.stages[index], self.queues[index], self.queues[index + 1]
+        try:
+            while (item := self.get(inbox)) is not END:
+                if not self.put(outbox, stage(item)):
+                    return
+            self.put(outbox, END)
+        except BaseException as ex:
+            self.fail(ex)
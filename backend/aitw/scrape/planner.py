@@ -0,0 +1,141 @@
+import asyncio
+import logging
+import math
+
+from datetime import datetime, timedelta, timezone
+from typing import Callable, Dict, List, Optional, Tuple
+
+from aitw.database.connection import connection
+from aitw.scrape.async_scraper import AsyncGitHubScraper
+from aitw.scrape.scraper import DATE_FORMAT
+from aitw.scrape.token_pool import TokenPool
+
+TARGET_PRS = 500 # Expected pull requests per job, well below the search limit so that estimation errors rarely force a split
+MAX_WINDOW = 6 * 3600 # Seconds, caps the duration of jobs in quiet periods
+PROFILE_WEEKS = 4 # Weeks of our own history the hourly profile is averaged over
+PROBE_CONCURRENCY = 8 # Count requests in flight while probing
+
+COLUMNS = {'created': 'created_at', 'closed': 'closed_at', 'updated': 'updated_at'}
+
+HOUR = timedelta(hours=1)
+
+# Expected number of pull requests in the hour starting at the given (UTC) time
+Estimate = Callable[[datetime], float]
+
+
+def hour_of(t: datetime) -> datetime:
+    return t.replace(minute=0, second=0, microsecond=0)
+
+
+def hours(start: datetime, end: datetime) -> List[datetime]:
+    """The hours that overlap [start, end)."""
+    result = []
+    hour = hour_of(start)
+    while hour < end:
+        result.append(hour)
+        hour += HOUR
+    return result
+
+
+def hourly_history(conninfo, time_key: str, start: datetime, end: datetime) -> Dict[datetime, int]:
+    """Pull requests per hour in [start, end) that are already in the database."""
+    column = COLUMNS[time_key]
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute(f"""
+            SELECT date_trunc('hour', {column}), COUNT(*) FROM prs
+            WHERE {column} >= %s AND {column} < %s
+            GROUP BY 1
+        """, (start.astimezone(timezone.utc).replace(tzinfo=None), end.astimezone(timezone.utc).replace(tzinfo=None)))
+        return {hour.replace(tzinfo=timezone.utc): count for hour, count in cur.fetchall()}
+
+
+def hourly_profile(conninfo, time_key: str, weeks=PROFILE_WEEKS) -> Dict[Tuple[int, int], float]:
+    """
+    Average pull requests per hour of the week, keyed by (ISO day of week, hour), over the last
+    `weeks` of our own data. Empty if there is no recent history.
+    """
+    column = COLUMNS[time_key]
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        # Only hours that were scraped count, so a database that was synced for a few days is not
+        # diluted by the weeks before
+        cur.execute(f"""
+            SELECT EXTRACT(ISODOW FROM hour)::int, EXTRACT(HOUR FROM hour)::int, AVG(count)
+            FROM (
+                SELECT date_trunc('hour', {column}) AS hour, COUNT(*) AS count FROM prs
+                WHERE {column} >= (NOW() AT TIME ZONE 'UTC') - make_interval(weeks => %s)
+                  AND {column} < date_trunc('hour', NOW() AT TIME ZONE 'UTC')
+                GROUP BY 1
+            ) AS hours
+            GROUP BY 1, 2
+        """, (weeks, ))
+        return {(dow, hour): float(count) for dow, hour, count in cur.fetchall()}
+
+
+def probe_hourly(tokens: List[str], time_key: str, start: datetime, end: datetime, filter="") -> Dict[datetime, int]:
+    """Counts the pull requests of every hour in [start, end) with one search count request each."""
+    async def run() -> Dict[datetime, int]:
+        semaphore = asyncio.Semaphore(PROBE_CONCURRENCY)
+        async with AsyncGitHubScraper(TokenPool(tokens), time_key=time_key) as scraper:
+            async def count(hour: datetime) -> Tuple[datetime, int]:
+                async with semaphore:
+                    return hour, await scraper.async_count(
+                        start_date=hour.strftime(DATE_FORMAT),
+                        end_date=(hour + HOUR - timedelta(seconds=1)).strftime(DATE_FORMAT),
+                        filter=filter,
+                    )
+            return dict(await asyncio.gather(*[count(hour) for hour in hours(start, end)]))
+
+    return asyncio.run(run())
+
+
+def estimate(conninfo, time_key: str, start: datetime, end: datetime, tokens: Optional[List[str]] = None) -> Optional[Estimate]:
+    """
+    Estimates the pull requests per hour of [start, end). With tokens the hours are counted by
+    probing the search, otherwise they are predicted from the hourly profile of our own history,
+    raised to the actual count of hours that are already in the database. None if neither is available.
+    """
+    if tokens:
+        logging.info(f'🔎 Probing {len(hours(start, end))} hours of {time_key} pull requests')
+        probed = probe_hourly(tokens, time_key, start, end)
+        return lambda hour: probed.get(hour, 0)
+
+    profile = hourly_profile(conninfo, time_key)
+    if not profile:
+        return None
+
+    history = hourly_history(conninfo, time_key, start, end)
+    # Hours without a single PR in the profile are rare enough to assume the overall average
+    average = sum(profile.values()) / len(profile)
+    return lambda hour: max(history.get(hour, 0), profile.get((hour.isoweekday(), hour.hour), average))
+
+
+def plan_windows(start: datetime, end: datetime, estimate: Estimate, target=TARGET_PRS, max_window=MAX_WINDOW) -> List[Tuple[datetime, datetime]]:
+    """
+    Cuts [start, end) into consecutive windows of whole seconds that are each expected to hold
+    `target` pull requests, assuming they are spread evenly within every hour. Quiet hours are merged
+    into windows of up to `max_window` seconds and hot ones are split into windows down to a second.
+    """
+    windows = []
+    start = start.replace(microsecond=0)
+    window_start = t = start
+    expected = 0.0
+    while t < end:
+        hour = hour_of(t)
+        segment_end = min(hour + HOUR, end, window_start + timedelta(seconds=max_window))
+        rate = estimate(hour) / HOUR.total_seconds()
+        seconds = (segment_end - t).total_seconds()
+
+        if rate > 0 and expected + rate * seconds >= target:
+            # The window fills up within this hour
+            t = min(t + timedelta(seconds=max(math.ceil((target - expected) / rate), 1)), segment_end)
+        else:
+            expected += rate * seconds
+            t = segment_end
+            if t < end and t - window_start < timedelta(seconds=max_window):
+                continue
+
+        windows.append((window_start, min(t, end)))
+        window_start = t
+        expected = 0.0
+
+    return windows
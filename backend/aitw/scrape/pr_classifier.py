@@ -3,6 +3,7 @@ from typing import Dict
 from tqdm import tqdm
 from aitw.database.pull_request import PullRequest
 from aitw.database.connection import connect
+from aitw.database import pull_request_codec as codec
 from aitw.database.pull_request_ingestor import BatchedPullRequestIngestor
 
 class PrClassifier:
@@ -102,6 +103,7 @@ class PrClassifier:
     
 def reclassify(dbconn_info):
     conn = connect(dbconn_info)
+    codec.register(conn)
     classifier = PrClassifier()
     
     with conn.cursor(name='streaming_all_reclassify') as streaming_cursor, conn.cursor() as ingestor_cursor:        
@@ -121,6 +123,8 @@ def reclassify(dbconn_info):
                 classifier.classify(pr)
                 ingestor.ingest(pr)
                 pbar.update(1)
+            
+            ingestor.flush()
     
     conn.commit()
     conn.close()
\ No newline at end of file
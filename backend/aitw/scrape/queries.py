@@ -0,0 +1,393 @@
+"""
+Static GraphQL documents used by the GitHubScraper.
+
+The documents never change between pages, only their variables do. Each query profile selects a
+different set of pull request fields so that jobs only pay (in rate limit points and payload size)
+for the fields they actually need.
+"""
+
+from functools import lru_cache
+
+RATE_LIMIT_FIELDS = """
+    rateLimit {
+        limit
+        cost
+        remaining
+        resetAt
+    }
+"""
+
+REPOSITORY_FIELDS = """
+fragment RepositoryFields on Repository {
+    id
+    nameWithOwner
+    stargazerCount
+    databaseId
+    url
+    isFork
+    forkCount
+    watchers {
+        totalCount
+    }
+    primaryLanguage {
+      name
+    }
+}
+"""
+
+# Only what identifies a repository, its metadata is kept fresh by REPOSITORIES_QUERY lookups
+REPOSITORY_LIGHT_FIELDS = """
+fragment RepositoryFields on Repository {
+    id
+    databaseId
+}
+"""
+
+PULL_REQUEST_FIELDS = """
+fragment PullRequestFields on PullRequest {
+    fullDatabaseId
+    title
+    url
+
+    bodyText
+
+    createdAt
+    mergedAt
+    closedAt
+    updatedAt
+    isDraft
+
+    changedFiles
+    additions
+    deletions
+
+    author { login, __typename }
+
+    comments(first:100) {
+        totalCount
+        nodes {
+            databaseId
+            createdAt
+            author {
+                login
+                __typename
+            }
+            bodyText
+        }
+    }
+
+    reviews {
+        totalCount
+    }
+
+    commits(first: 1) {
+        totalCount
+        nodes {
+            commit {
+                authors(first:2) {
+                    nodes {
+                        name
+                        email
+                    }
+                }
+            }
+        }
+    }
+
+    files(first:100) {
+        nodes {
+            additions
+            deletions
+            path
+        }
+    }
+
+    baseRefName
+    baseRepository {
+        ...RepositoryFields
+    }
+
+    headRefName
+    headRepository {
+        ...RepositoryFields
+    }
+}
+"""
+
+PULL_REQUEST_STATUS_FIELDS = """
+fragment PullRequestFields on PullRequest {
+    fullDatabaseId
+    createdAt
+    mergedAt
+    closedAt
+    updatedAt
+    isDraft
+}
+"""
+
+# Search selection of the two-phase (deferred) mode: everything but the connections with many nodes,
+# which are fetched afterwards through DETAILS_QUERY for the pull requests that have any
+PULL_REQUEST_LIGHT_FIELDS = """
+fragment PullRequestFields on PullRequest {
+    id
+    fullDatabaseId
+    title
+    url
+
+    bodyText
+
+    createdAt
+    mergedAt
+    closedAt
+    updatedAt
+    isDraft
+
+    changedFiles
+    additions
+    deletions
+
+    author { login, __typename }
+
+    comments {
+        totalCount
+    }
+
+    reviews {
+        totalCount
+    }
+
+    commits {
+        totalCount
+    }
+
+    baseRefName
+    baseRepository {
+        ...RepositoryFields
+    }
+
+    headRefName
+    headRepository {
+        ...RepositoryFields
+    }
+}
+"""
+
+COMMENT_FIELDS = """
+fragment CommentFields on IssueComment {
+    databaseId
+    createdAt
+    author {
+        login
+        __typename
+    }
+    bodyText
+}
+"""
+
+FILE_FIELDS = """
+fragment FileFields on PullRequestChangedFile {
+    additions
+    deletions
+    path
+}
+"""
+
+DETAILS_QUERY = """
+query Details($commitIds: [ID!]!, $fileIds: [ID!]!, $commentIds: [ID!]!) {
+""" + RATE_LIMIT_FIELDS + """
+    authors: nodes(ids: $commitIds) {
+        ... on PullRequest {
+            id
+            commits(first: 1) {
+                totalCount
+                nodes {
+                    commit {
+                        authors(first:2) {
+                            nodes {
+                                name
+                                email
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+    files: nodes(ids: $fileIds) {
+        ... on PullRequest {
+            id
+            files(first:100) {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                nodes {
+                    ...FileFields
+                }
+            }
+        }
+    }
+    discussions: nodes(ids: $commentIds) {
+        ... on PullRequest {
+            id
+            comments(first:100) {
+                totalCount
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                nodes {
+                    ...CommentFields
+                }
+            }
+        }
+    }
+}
+""" + FILE_FIELDS + COMMENT_FIELDS
+
+FILES_PAGE_QUERY = """
+query Files($id: ID!, $after: String) {
+""" + RATE_LIMIT_FIELDS + """
+    node(id: $id) {
+        ... on PullRequest {
+            files(first:100, after: $after) {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                nodes {
+                    ...FileFields
+                }
+            }
+        }
+    }
+}
+""" + FILE_FIELDS
+
+COMMENTS_PAGE_QUERY = """
+query Comments($id: ID!, $after: String) {
+""" + RATE_LIMIT_FIELDS + """
+    node(id: $id) {
+        ... on PullRequest {
+            comments(first:100, after: $after) {
+                pageInfo {
+                    endCursor
+                    hasNextPage
+                }
+                nodes {
+                    ...CommentFields
+                }
+            }
+        }
+    }
+}
+""" + COMMENT_FIELDS
+
+REPOSITORIES_QUERY = """
+query Repositories($repositoryIds: [ID!]!) {
+""" + RATE_LIMIT_FIELDS + """
+    repositories: nodes(ids: $repositoryIds) {
+        ... on Repository {
+            ...RepositoryFields
+        }
+    }
+}
+""" + REPOSITORY_FIELDS
+
+SEARCH_QUERY = """
+query Search($query: String!, $first: Int!, $after: String) {
+""" + RATE_LIMIT_FIELDS + """
+    search(type: ISSUE, query: $query, first: $first, after: $after) {
+        issueCount
+        pageInfo {
+            endCursor
+            hasNextPage
+        }
+        nodes {
+            ... on PullRequest {
+                ...PullRequestFields
+            }
+        }
+    }
+}
+"""
+
+COUNT_QUERY = """
+query Count($query: String!) {
+""" + RATE_LIMIT_FIELDS + """
+    search(type: ISSUE, query: $query, first: 0) {
+        issueCount
+    }
+}
+"""
+
+# Name of the profile -> fragments selected for every search node
+PROFILE_FRAGMENTS = {
+    # Everything we store about a pull request and its base and head repositories
+    "full": PULL_REQUEST_FIELDS + REPOSITORY_FIELDS,
+    # Full pull requests, but only the ids of their repositories
+    "repo-light": PULL_REQUEST_FIELDS + REPOSITORY_LIGHT_FIELDS,
+    # Only the fields that change when a pull request gets closed or merged
+    "status": PULL_REQUEST_STATUS_FIELDS,
+    # Two-phase mode: light search pages, comments, commits and files are fetched through DETAILS_QUERY
+    "deferred": PULL_REQUEST_LIGHT_FIELDS + REPOSITORY_LIGHT_FIELDS,
+}
+
+# Name of the profile -> search document
+PROFILES = {name: SEARCH_QUERY + fragments for name, fragments in PROFILE_FRAGMENTS.items()}
+
+
+@lru_cache
+def batched_search_query(profile: str, size: int) -> str:
+    """Search document with `size` aliased searches (search0, search1, ...) in a single request."""
+    variables = ', '.join(f'$query{i}: String!, $first{i}: Int!, $after{i}: String' for i in range(size))
+    searches = ''.join(f"""
+    search{i}: search(type: ISSUE, query: $query{i}, first: $first{i}, after: $after{i}) {{
+        ...SearchFields
+    }}""" for i in range(size))
+    
+    return f"""
+query BatchedSearch({variables}) {{
+{RATE_LIMIT_FIELDS}{searches}
+}}
+
+fragment SearchFields on SearchResultItemConnection {{
+    issueCount
+    pageInfo {{
+        endCursor
+        hasNextPage
+    }}
+    nodes {{
+        ... on PullRequest {{
+            ...PullRequestFields
+        }}
+    }}
+}}
+""" + PROFILE_FRAGMENTS[profile]
+
+
+@lru_cache
+def batched_count_query(size: int) -> str:
+    """Count-only document with `size` aliased searches (search0, search1, ...) in a single request."""
+    variables = ', '.join(f'$query{i}: String!' for i in range(size))
+    searches = ''.join(f"""
+    search{i}: search(type: ISSUE, query: $query{i}, first: 0) {{
+        issueCount
+    }}""" for i in range(size))
+    
+    return f"""
+query BatchedCount({variables}) {{
+{RATE_LIMIT_FIELDS}{searches}
+}}
+"""
+
+
+def select_profile(group: str, time_key: str, two_phase=False) -> str:
+    """Selects the query profile for a job."""
+    if time_key == "closed":
+        # Every pull request is scraped in full by the created job of its creation minute,
+        # the closed job only has to refresh its status
+        return "status"
+
+    # Repository metadata is refreshed separately (aitw.scrape.repos), pull requests only reference them
+    return "deferred" if two_phase else "repo-light"
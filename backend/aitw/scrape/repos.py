@@ -0,0 +1,111 @@
+"""
+Refreshes the metadata (stars, forks, language, ...) of the repositories in the database.
+
+Pull request searches only reference their repositories, this job looks them up in batches through
+nodes(ids:), the least recently refreshed (and never refreshed) ones first.
+"""
+
+import base64
+import time
+
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+from tqdm import tqdm
+
+from aitw.database.connection import connection
+from aitw.database.repository import Repository
+from aitw.scrape.scraper import GitHubScraper
+from aitw.scrape.token_pool import TokenPool
+
+REFRESH_BATCH = 100 # Repositories per nodes(ids:) lookup, the most GitHub accepts
+MAX_AGE = 7 * 24 * 3600 # Seconds after which the metadata of a repository is refreshed
+IDLE_INTERVAL = 300 # Seconds to wait once every repository is fresh
+
+
+def legacy_node_id(id: int) -> str:
+    """Node id in the legacy format, which GitHub still resolves, for repositories stored without one."""
+    return base64.b64encode(f"010:Repository{id}".encode()).decode()
+
+
+def claim_stale(conninfo, limit: int, max_age: int) -> List[Tuple[int, Optional[str], Optional[datetime]]]:
+    """
+    Claims up to `limit` repositories that were not refreshed for `max_age` seconds by marking them
+    as refreshed, so that several refreshers can run at once. Returns (id, node id, previous refresh).
+    """
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute("""
+            UPDATE repos
+            SET refreshed_at = NOW()
+            FROM (
+                SELECT id, refreshed_at FROM repos
+                WHERE refreshed_at IS NULL OR refreshed_at < NOW() - make_interval(secs => %(max_age)s)
+                ORDER BY refreshed_at NULLS FIRST
+                LIMIT %(limit)s
+                FOR UPDATE SKIP LOCKED
+            ) AS stale
+            WHERE repos.id = stale.id
+            RETURNING repos.id, repos.node_id, stale.refreshed_at
+        """, {'limit': limit, 'max_age': max_age})
+        return cur.fetchall()
+
+
+def release(conninfo, claimed: List[Tuple[int, Optional[str], Optional[datetime]]]):
+    """Restores the refresh time of claimed repositories that could not be refreshed."""
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.executemany("""
+            UPDATE repos SET refreshed_at = %s WHERE id = %s
+        """, [(refreshed_at, id) for id, _, refreshed_at in claimed])
+
+
+def store(conninfo, repositories: List[Repository]):
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.executemany("""
+            UPDATE repos
+            SET name = %s, url = %s, fork = %s, forks = %s, watchers = %s, stars = %s, primary_language = %s, node_id = %s
+            WHERE id = %s
+        """, [
+            (repo.name, repo.url, repo.is_fork, repo.forks, repo.watchers, repo.stargazers, repo.primary_language, repo.node_id, repo.id)
+            for repo in sorted(repositories, key=lambda repo: repo.id)
+        ])
+
+
+def refresh_batch(scraper: GitHubScraper, conninfo, claimed: List[Tuple[int, Optional[str], Optional[datetime]]]) -> Tuple[int, int]:
+    """Looks up the claimed repositories and stores their metadata. Returns the number refreshed and gone."""
+    try:
+        found = scraper.repositories([node_id or legacy_node_id(id) for id, node_id, _ in claimed])
+    except Exception:
+        release(conninfo, claimed)
+        raise
+
+    # Repositories that were deleted (or made private) keep their last known metadata
+    repositories = [repo for repo in found if repo is not None]
+    store(conninfo, repositories)
+    return len(repositories), len(claimed) - len(repositories)
+
+
+def count_stale(conninfo, max_age: int) -> int:
+    with connection(conninfo) as conn, conn.cursor() as cur:
+        cur.execute("""
+            SELECT COUNT(*) FROM repos WHERE refreshed_at IS NULL OR refreshed_at < NOW() - make_interval(secs => %s)
+        """, (max_age, ))
+        return cur.fetchone()[0]
+
+
+def refresh(tokens: List[str], conninfo, batch=REFRESH_BATCH, max_age=MAX_AGE, once=False):
+    """Refreshes stale repositories, forever or (`once`) until every repository is fresh."""
+    scraper = GitHubScraper(TokenPool(tokens))
+    while True:
+        refreshed, gone = 0, 0
+        with tqdm(total=count_stale(conninfo, max_age), smoothing=0.0) as bar:
+            while len(claimed := claim_stale(conninfo, batch, max_age)) > 0:
+                batch_refreshed, batch_gone = refresh_batch(scraper, conninfo, claimed)
+                refreshed += batch_refreshed
+                gone += batch_gone
+                bar.update(len(claimed))
+        
+        print(f'✅ Refreshed {refreshed} repositories, {gone} are gone')
+        if once:
+            return
+        
+        time.sleep(IDLE_INTERVAL)
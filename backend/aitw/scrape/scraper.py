@@ -1,63 +1,183 @@
-
+import math
+import os
 import requests
 import logging
 import time
 
-from typing import Iterator, Optional
+from dataclasses import asdict, dataclass, field
+from datetime import datetime, timedelta
+from typing import Any, Dict, Generator, Iterator, List, Optional, Tuple, TypeVar
+
+from aitw.database.pull_request import Actor, Comment, Commit, CommitAuthor, PullRequest, PullRequestFile, PullRequestStatus
+from aitw.database.repository import Repository, RepositoryRef
+from aitw.scrape.queries import (
+    COMMENTS_PAGE_QUERY, COUNT_QUERY, DETAILS_QUERY, FILES_PAGE_QUERY, PROFILES, REPOSITORIES_QUERY, batched_count_query, batched_search_query
+)
+from aitw.scrape.page_size import PageSizeController
+from aitw.scrape.token_pool import TokenPool, TokenState
+
+
+DATE_FORMAT = "%Y-%m-%dT%H:%M:%S"
+
+
+@dataclass
+class ScrapeState:
+    windows: List[Tuple[str, str]] # Pending (start, end) search windows, the last one is scraped next
+    after: Optional[str] = None # Cursor into the last window
+    
+    expected: Optional[int] = None # Number of results of the whole scrape, taken from the first page
+    scraped: int = 0
+    counts: Dict[str, int] = field(default_factory=dict) # Probed number of results of pending windows, by window_key
+    
+    def to_dict(self) -> Dict[str, Any]:
+        return asdict(self)
+    
+    @staticmethod
+    def from_dict(data: Dict[str, Any]) -> 'ScrapeState':
+        return ScrapeState(
+            windows=[(start, end) for start, end in data['windows']],
+            after=data['after'],
+            expected=data['expected'],
+            scraped=data['scraped'],
+            counts=data.get('counts', {}),
+        )
+
+
+def window_key(start_date: str, end_date: str) -> str:
+    return f'{start_date}..{end_date}'
+
+
+@dataclass
+class GraphQLRequest:
+    query: str
+    variables: Dict[str, Any] = field(default_factory=dict)
+    metadata: Optional[Dict[str, Any]] = None
+    partial: bool = False # Accepts data with NOT_FOUND errors, e.g. nodes(ids:) lookups of deleted nodes
+    
+    def payload(self) -> Dict[str, Any]:
+        return {"query": self.query, "variables": self.variables}
+
+
+@dataclass
+class GraphQLResponse:
+    data: Dict[str, Any]
+    elapsed: float
+
+
+ScrapedObject = PullRequest | PullRequestStatus | Repository | RepositoryRef | None
+
+# The scraping logic is written once as a generator of steps: it yields a GraphQLRequest whenever it
+# needs data (and is sent back the GraphQLResponse) and yields scraped objects otherwise. The sync
+# scraper and the async scraper (aitw.scrape.async_scraper) only differ in how they drive it.
+ScrapeSteps = Generator[GraphQLRequest | ScrapedObject, GraphQLResponse, None]
+BatchedScrapeSteps = Generator[GraphQLRequest | Tuple[int, ScrapedObject], GraphQLResponse, None]
+
+T = TypeVar('T')
 
-from aitw.database.pull_request import Actor, Comment, Commit, CommitAuthor, PullRequest, PullRequestFile
-from aitw.database.repository import Repository
 
 class GitHubScraper:
-    batch_size = 25
+    batch_size = 25 # Initial search page size, the PageSizeController adapts it
+    timeout = 60
+    search_limit = 1000 # GitHub search never returns more than 1,000 results per query
+    search_fill = 0.8 # Target fill of the search limit when splitting dense windows
+    deferred_batch_size = 100 # Initial search page size of the two-phase mode, its pages are light
+    details_batch_size = 25 # Pull requests per nodes(ids:) lookup of the two-phase mode
+    max_connection_pages = 30 # Pages of files/comments followed per pull request in the two-phase mode
+    alias_batch_size = 10 # Search windows packed into one request by scrape_batched
     
-    def __init__(self, token: str, time_key='created'):
-        self.url = "https://api.github.com/graphql"
-        self.headers = {
-            "Authorization": f"Bearer {token}",
-            "Accept": "application/vnd.github+json",
-        }
+    def __init__(self, token: str | TokenPool, time_key='created', session: Optional[requests.Session] = None, profile='full',
+                 page_size: Optional[PageSizeController] = None):
+        # Point GITHUB_GRAPHQL_URL at a stand-in (e.g. aitw.bench.fake_github) to scrape offline
+        self.url = os.getenv("GITHUB_GRAPHQL_URL", "https://api.github.com/graphql")
+        self.tokens = token if isinstance(token, TokenPool) else TokenPool([token])
         self.pbar = None
-        self.total_expected = None
         self.time_key = time_key
+        self.profile = profile
+        # The page size is learned from the observed latency, cost and failures. Pass in a shared
+        # controller to keep learning across jobs
+        self.page_size = page_size or self.page_size_controller(profile)
+        self.state: Optional[ScrapeState] = None
+        self.states: List[ScrapeState] = []
+        self.requests = 0
+        self.cost = 0
+        # Keep-alive connections are reused across pages (and across jobs if the session is shared)
+        self.session = session or requests.Session()
         
-    def request_and_backoff(self, query, metadata=None):
+    @staticmethod
+    def headers(token: TokenState) -> Dict[str, str]:
+        return {
+            "Authorization": f"Bearer {token.token}",
+            "Accept": "application/vnd.github+json",
+        }
+        
+    def handle_response(self, token: TokenState, response, elapsed: float, request: Optional[GraphQLRequest] = None) -> Optional[GraphQLResponse]:
+        if response.status_code == 200:
+            data = response.json()
+            
+            errors = data.get("errors")
+            if errors and request is not None and request.partial and data.get("data") and all(error.get("type") == "NOT_FOUND" for error in errors):
+                # Nodes that are gone come back as null next to their error
+                errors = None
+
+            if errors:
+                logging.info(f"❌ GraphQL Error: {errors}")
+            else:
+                self.tokens.update(token, data['data']['rateLimit'])
+                self.requests += 1
+                self.cost += data['data']['rateLimit']['cost']
+                logging.info(f"💰 The last query cost {data['data']['rateLimit']['cost']} points. Remaining {data['data']['rateLimit']['remaining']} ({token.name})")
+                logging.info(f'✅ {response.status_code} in {elapsed*1000:.0f}ms')
+                return GraphQLResponse(data=data['data'], elapsed=elapsed)
+        elif response.status_code >= 500 and response.status_code < 600:
+            logging.info(f"❌ Internal Error {response.status_code} {response.text}")
+            raise TimeoutError()
+        else:
+            logging.info(f"❌ Status Code {response.status_code} {response.text}")
+            
+        return None
+    
+    @staticmethod
+    def retry_hints(response) -> Tuple[int, Optional[int]]:
+        """Returns the seconds until an exhausted rate limit resets and the requested Retry-After (if any)."""
+        header_reset_in = response.headers.get("X-RateLimit-Reset")
+        header_remaining = response.headers.get("X-RateLimit-Remaining")
+        header_retry_after = response.headers.get("Retry-After")
+        
+        # GitHub sends the reset header on every response, it only matters once the limit is used up
+        exhausted = header_remaining is None or int(header_remaining) == 0
+        reset_in = int(header_reset_in) - int(time.time()) if header_reset_in is not None and exhausted else 0
+        retry_after = int(header_retry_after) if header_retry_after is not None else None
+        return reset_in, retry_after
+        
+    def request_and_backoff(self, request: GraphQLRequest) -> GraphQLResponse:
         backoff = 1
         while True:
+            token, wait = self.tokens.acquire()
+            if wait > 0:
+                logging.info(f'🐢 Pacing {token.name} for {wait:.1f}s')
+                time.sleep(wait)
+                
             try:
-                logging.info(f'👉 Request: {metadata or ""}')
+                logging.info(f'👉 Request: {request.metadata or ""}')
                 
                 start_req_time = time.time()
-                response = requests.post(
-                    self.url, json={"query": query}, headers=self.headers, timeout=60
+                response = self.session.post(
+                    self.url, json=request.payload(), headers=self.headers(token), timeout=self.timeout
                 )
-                if response.status_code == 200:
-                    data = response.json()
-
-                    if "errors" in data:
-                        logging.info(f"❌ GraphQL Error: {data['errors']}")
-                    else:
-                        logging.info(f"💰 The last query cost {data['data']['rateLimit']['cost']} points. Remaining {data['data']['rateLimit']['remaining']}")
-                        logging.info(f'✅ {response.status_code} in {(time.time() - start_req_time)*1000:.0f}ms')
-                        return response
-                elif response.status_code >= 500 and response.status_code < 600:
-                    logging.info(f"❌ Internal Error {response.status_code} {response.text}")
-                    raise TimeoutError()
-                else:
-                    logging.info(f"❌ Status Code {response.status_code} {response.text}")
+                result = self.handle_response(token, response, time.time() - start_req_time, request)
+                if result is not None:
+                    return result
                     
-                if response is not None:
-                    header_reset_in = response.headers.get("X-RateLimit-Reset")
-                    header_retry_after = response.headers.get("Retry-After")
+                reset_in, retry_after = self.retry_hints(response)
+                if reset_in > 0:
+                    # Park the token and retry right away, the pool routes to a token with headroom
+                    # (or waits for the earliest reset if all of them are exhausted)
+                    self.tokens.exhausted(token, time.time() + reset_in)
+                    continue
                     
-                    if header_reset_in is not None:
-                        reset_in = int(header_reset_in) - int(time.time())
-                        if reset_in > 0:
-                            logging.info(f"🔁 Reset rate limit in {reset_in}s, sleeping for that amount!")    
-                            time.sleep(reset_in)
-                        
-                    if header_retry_after is not None:
-                        backoff = max(backoff, int(header_retry_after))
+                if retry_after is not None:
+                    self.tokens.delay(token, retry_after)
+                    backoff = max(backoff, retry_after)
                         
             except requests.exceptions.Timeout:
                 logging.info("❌ requests.exceptions.Timeout")
@@ -73,243 +193,411 @@ class GitHubScraper:
             time.sleep(backoff)
             backoff *= 2 
         
+    @classmethod
+    def page_size_controller(cls, profile: str) -> PageSizeController:
+        return PageSizeController(initial=cls.deferred_batch_size if profile == "deferred" else cls.batch_size)
+        
+    @property
+    def expected_total(self) -> Optional[int]:
+        """Number of pull requests in the scraped window, known as soon as the first page arrived."""
+        return self.state.expected if self.state is not None else None
+    
+    def progress(self) -> Dict[str, Any]:
+        if self.state is None:
+            return {}
+        
+        return {
+            'expected': self.state.expected,
+            'scraped': self.state.scraped,
+            'requests': self.requests,
+            'cost': self.cost,
+            'pending_windows': len(self.state.windows),
+            **self.page_size.stats(),
+        }
+        
     def count(self, start_date: str, end_date: str, filter: str):
-        query = self.build_query(filter=filter, start_date=start_date, end_date=end_date, first=0, after=None)
+        query = self.search_query(filter=filter, start_date=start_date, end_date=end_date)
         
-        response = self.request_and_backoff(query)
-        data = response.json()
-        return data["data"]["search"]["issueCount"]
+        response = self.request_and_backoff(GraphQLRequest(COUNT_QUERY, {"query": query}))
+        return response.data["search"]["issueCount"]
 
-    def scrape(self, start_date: str, end_date: str, filter: str) -> Iterator[PullRequest | Repository | None]:
-        curr_start_date = start_date # Current start to bypass 1,000 search limit
-        curr_after = None # Cursor based pagination
-        num_res_page = 0 # Number of results returned on current page (must be < 1,000)
-        curr_batch_size = self.batch_size
+    def repositories(self, node_ids: List[str]) -> List[Optional[Repository]]:
+        """Looks up up to 100 repositories by their node ids, None for the ones that are gone."""
+        response = self.request_and_backoff(GraphQLRequest(REPOSITORIES_QUERY, {"repositoryIds": node_ids}, partial=True))
+        return [self.parse_repository(repo) if repo else None for repo in response.data["repositories"]]
 
-        while True:
-            query = self.build_query(filter=filter, start_date=curr_start_date, end_date=end_date, first=curr_batch_size, after=curr_after)
-            try:
-                response = self.request_and_backoff(query, {'batch_size': curr_batch_size, 'start_date':curr_start_date, 'after': curr_after})
-                
-                data = response.json()
-
-                search_data = data["data"]["search"]
-                items = search_data["nodes"]
-                print(f'Retuned {len(items)} items')
-
-                for item in items:
-                    yield PullRequest(
-                        id=item['fullDatabaseId'],
-                        url=item['url'],
-                        title=item['title'],
-                        body=item['bodyText'],
-                        agent = None,
-                        actor=Actor(
-                            login=item['author'] and item['author']['login'],
-                            type=item['author'] and item['author']['__typename']
-                        ),
-                        created_at = item['createdAt'],
-                        closed_at = item['closedAt'],
-                        isMerged = item['mergedAt'] is not None,
-                        isDraft= item['isDraft'],
-                        additions = item['additions'],
-                        deletions = item['deletions'],
-                        changed_files = item['changedFiles'],
-                        commits = item['commits']['totalCount'],
-                        comments = item['comments']['totalCount'],
-                        reviews = item['reviews']['totalCount'],
-                        
-                        base_ref = item['baseRefName'],
-                        head_ref = item['headRefName'],
-                        base_repo_id = item['baseRepository'] and item['baseRepository']['databaseId'],
-                        head_repo_id = item['headRepository'] and item['headRepository']['databaseId'],
-                        commitsList = [
-                            Commit(authors=[
-                                CommitAuthor(name=x['name'], email=x['email'])
-                                for x in n['commit']['authors']['nodes']
-                            ]) 
-                            for n in item['commits']['nodes'] if n is not None
-                        ],
-                        files = [
-                            PullRequestFile(additions=n['additions'], deletions=n['deletions'], path=n['path']) 
-                            for n in item['files']['nodes'] if n is not None
-                        ] if item['files'] is not None else None,
-                        commentsList = [
-                            Comment(
-                                id=n['databaseId'], 
-                                created_at=n['createdAt'],
-                                author=Actor(login=n['author']['login'], type=n['author']['__typename']) if n['author'] is not None else None,
-                                body=n['bodyText']) 
-                            for n in item['comments']['nodes'] if n is not None
-                        ] if item['comments'] is not None else None, 
-                    )
-                    
-                    if item['baseRepository']:
-                        yield Repository(
-                            id=item['baseRepository']['databaseId'],
-                            name=item['baseRepository']['nameWithOwner'],
-                            url=item['baseRepository']['url'],
-                            is_fork=item['baseRepository']['isFork'],
-                            stargazers=item['baseRepository']['stargazerCount'],
-                            watchers=item['baseRepository']['watchers']['totalCount'],
-                            forks=item['baseRepository']['forkCount'],
-                            primary_language=item['baseRepository']['primaryLanguage'] and item['baseRepository']['primaryLanguage']['name']
-                        )
-                        
-                    if item['headRepository']:
-                        yield Repository(
-                            id=item['headRepository']['databaseId'],
-                            name=item['headRepository']['nameWithOwner'],
-                            url=item['headRepository']['url'],
-                            is_fork=item['headRepository']['isFork'],
-                            stargazers=item['headRepository']['stargazerCount'],
-                            watchers=item['headRepository']['watchers']['totalCount'],
-                            forks=item['headRepository']['forkCount'],
-                            primary_language=item['headRepository']['primaryLanguage'] and item['headRepository']['primaryLanguage']['name']
-                        )
+    def scrape(self, start_date: str, end_date: str, filter: str, state: Optional[ScrapeState] = None) -> Iterator[ScrapedObject]:
+        """
+        Scrapes the window. Pass the state of an interrupted scrape to resume it, it is consistent
+        whenever a page boundary (None) is yielded.
+        """
+        self.state = state or ScrapeState(windows=[(start_date, end_date)])
+        return self.drive(self.scrape_steps(start_date=start_date, end_date=end_date, filter=filter, state=self.state))
+    
+    def drive(self, steps: Generator[GraphQLRequest | T, GraphQLResponse, None]) -> Iterator[T]:
+        try:
+            step = next(steps)
+            while True:
+                if isinstance(step, GraphQLRequest):
+                    try:
+                        response = self.request_and_backoff(step)
+                    except (Exception, KeyboardInterrupt) as ex:
+                        # Let the steps decide how to react (e.g. reduce the batch size on timeouts)
+                        step = steps.throw(ex)
+                    else:
+                        step = steps.send(response)
+                else:
+                    yield step
+                    step = next(steps)
+        except StopIteration:
+            return
 
-                if not items:
-                    return
+    def scrape_steps(self, start_date: str, end_date: str, filter: str, state: Optional[ScrapeState] = None) -> ScrapeSteps:
+        state = state or ScrapeState(windows=[(start_date, end_date)])
+        while state.windows:
+            yield from self.probe_steps(filter, state)
+            
+            curr_start_date, curr_end_date = state.windows[-1]
+            curr_batch_size = self.page_size.size
+            request = self.build_request(
+                filter=filter, start_date=curr_start_date, end_date=curr_end_date, first=curr_batch_size, after=state.after,
+                metadata={'batch_size': curr_batch_size, 'start_date': curr_start_date, 'end_date': curr_end_date, 'after': state.after, 'profile': self.profile}
+            )
+            try:
+                response = yield request
+                self.page_size.success(response.elapsed, response.data["rateLimit"]["cost"])
 
-                if num_res_page + 2*curr_batch_size < 1000:
-                    curr_after = search_data["pageInfo"]["endCursor"]
-                    num_res_page += curr_batch_size
-                elif curr_start_date == items[-1]["createdAt"]:
-                    logging.error('‼ We have a problem. We maxed out the GraphQL page limit but the start date did not change :(')
-                    raise ValueError('Maxed out the GraphQL page limit but start date did not change :(')
-                else:
-                    curr_start_date = items[-1]["createdAt"]
-                    curr_after = None
-                    
-                curr_batch_size = self.batch_size
+                items = self.advance(state, response.data["search"])
+                logging.info(f'Returned {len(items)} items')
                 
+                if self.profile == "deferred":
+                    yield from self.details_steps(items)
 
-                if search_data["issueCount"] <= self.batch_size:
-                    return
+                for item in items:
+                    yield from self.parse_item(item)
 
             except KeyboardInterrupt:
                 logging.error("\n❌ Interrupted by user. Exiting.")
                 exit(1)
             
             except TimeoutError:
-                logging.warning(f"⚠️ Timeout: Reducing batch_size and retry! (batch_size {curr_batch_size} -> {curr_batch_size//2})")
-                if curr_batch_size > 1:
-                    curr_batch_size //= 2
+                self.page_size.failure()
+                logging.warning(f"⚠️ Timeout: Reducing batch_size and retry! (batch_size {curr_batch_size} -> {self.page_size.size})")
             except Exception as e:
                 logging.error(f"⚠️ Exception occurred: {e}")
                 logging.error(e)
                 raise e
-            finally:
-                # Gives the caller time to react in long retry loops cycles
-                yield None
-
-    def build_query(self, filter: str, start_date: str, end_date: str, first: int, after: Optional[str]) -> str:
-        return f"""
-        query {{
-            rateLimit {{
-                cost
-                remaining
-            }}
-            search(type: ISSUE, query: "is:pr {filter} {self.time_key}:{start_date}..{end_date} sort:created-asc", first: {first}, after: {f'"{after}"' if after is not None else 'null'}) {{
-                issueCount
-                pageInfo {{
-                    endCursor
-                    hasNextPage
-                }}
-                nodes {{
-                    ... on PullRequest {{
-                        fullDatabaseId
-                        title
-                        url
-                        
-                        bodyText
-                        
-                        createdAt
-                        mergedAt
-                        closedAt
-                        updatedAt
-                        isDraft
-                        
-                        changedFiles
-                        additions
-                        deletions
-                        
-                        author {{ login, __typename }}
-                        
-                        comments(first:100) {{
-                            totalCount
-                            nodes {{
-                                databaseId
-                                createdAt
-                                author {{
-                                    login
-                                    __typename
-                                }}
-                                bodyText  
-                            }}
-                        }}
-                        
-                        reviews {{
-                            totalCount
-                        }}
-                        
-                        commits(first: 1) {{
-                            totalCount
-                            nodes {{
-                                commit {{
-                                    authors(first:2) {{
-                                        nodes {{
-                                            name
-                                            email
-                                        }}
-                                    }}
-                                }}
-                            }}
-                        }}
-                        
-                        files(first:100) {{
-                            nodes {{
-                                additions
-                                deletions
-                                path
-                            }}
-                        }}
-                        
-                        baseRefName
-                        baseRepository {{
-                            nameWithOwner
-                            stargazerCount
-                            databaseId
-                            url
-                            isFork
-                            forkCount
-                            watchers {{
-                                totalCount
-                            }}
-                            primaryLanguage {{
-                              name
-                            }}
-                        }}
-                        
-                        headRefName
-                        headRepository {{
-                            nameWithOwner
-                            stargazerCount
-                            databaseId
-                            url
-                            isFork
-                            forkCount
-                            watchers {{
-                                totalCount
-                            }}
-                            primaryLanguage {{
-                              name
-                            }}
-                        }}
-                    }}
-                }}
-            }}
-        }}
+            
+            # Gives the caller time to react in long retry loops cycles
+            yield None
+            
+    def advance(self, state: ScrapeState, search_data: Dict[str, Any]) -> List[Dict[str, Any]]:
+        """Advances the state past a search page of its current window and returns the nodes of the page."""
+        curr_start_date, curr_end_date = state.windows[-1]
+        issue_count = search_data["issueCount"]
+        
+        if state.expected is None:
+            # The first page covers the whole window, no need for a separate count request
+            state.expected = issue_count
+        
+        # Search only returns the first 1,000 results of a query, so dense windows are split
+        # (by their density) until every sub-window fits, sparse windows are walked in one pass
+        if state.after is None and self.split(state, issue_count):
+            return []
+        
+        items = search_data["nodes"]
+        if items and search_data["pageInfo"]["hasNextPage"]:
+            state.after = search_data["pageInfo"]["endCursor"]
+        else:
+            state.windows.pop()
+            state.counts.pop(window_key(curr_start_date, curr_end_date), None)
+            state.after = None
+            
+        state.scraped += len(items)
+        return items
+    
+    def split(self, state: ScrapeState, issue_count: int) -> bool:
+        """Replaces the current window of the state by sub-windows if it holds more results than search returns."""
+        curr_start_date, curr_end_date = state.windows[-1]
+        if issue_count <= self.search_limit:
+            return False
+        
+        sub_windows = self.split_window(curr_start_date, curr_end_date, issue_count)
+        if len(sub_windows) < 2:
+            logging.warning(f'⚠️ {issue_count} results in the single second {curr_start_date}, only the first {self.search_limit} can be scraped')
+            return False
+        
+        logging.info(f'🔪 {issue_count} results in {curr_start_date}..{curr_end_date}, splitting into {len(sub_windows)} windows')
+        state.windows[-1:] = reversed(sub_windows)
+        state.counts.pop(window_key(curr_start_date, curr_end_date), None)
+        return True
+    
+    def probe_steps(self, filter: str, state: ScrapeState) -> Generator[GraphQLRequest, GraphQLResponse, None]:
         """
+        Counts the sub-windows of a split before their first page is fetched, in aliased count-only
+        searches, and splits the ones that are still too dense. Their pages of nodes would be thrown
+        away otherwise.
+        """
+        # Windows other than the one of the first page are sub-windows of a split
+        while state.after is None and state.expected is not None:
+            key = window_key(*state.windows[-1])
+            if key not in state.counts:
+                unknown = [window for window in reversed(state.windows) if window_key(*window) not in state.counts][:self.alias_batch_size]
+                try:
+                    response = yield GraphQLRequest(
+                        batched_count_query(len(unknown)),
+                        {f'query{i}': self.search_query(filter=filter, start_date=start_date, end_date=end_date) for i, (start_date, end_date) in enumerate(unknown)},
+                        {'probe': len(unknown)}
+                    )
+                except TimeoutError:
+                    logging.warning(f"⚠️ Timeout: Fetching {key} without probing it")
+                    return
+                
+                for i, window in enumerate(unknown):
+                    state.counts[window_key(*window)] = response.data[f'search{i}']['issueCount']
+                    
+            if not self.split(state, state.counts[key]):
+                return
+    
+    def parse_item(self, item: Dict[str, Any]) -> Iterator[PullRequest | PullRequestStatus | Repository | RepositoryRef]:
+        if self.profile == "status":
+            yield self.parse_status(item)
+        else:
+            # Only the full profile selects the metadata of the repositories
+            yield from self.parse_node(item, with_repositories=self.profile == "full")
+            
+    def scrape_batched(self, windows: List[Tuple[str, str, str]]) -> Iterator[Tuple[int, ScrapedObject]]:
+        """
+        Scrapes several (start_date, end_date, filter) windows, packing the next page of up to
+        `alias_batch_size` of them into one aliased request. Yields (window index, object) pairs.
+        """
+        self.states = [ScrapeState(windows=[(start_date, end_date)]) for start_date, end_date, _ in windows]
+        return self.drive(self.batched_scrape_steps([filter for _, _, filter in windows], self.states))
     
-    
\ No newline at end of file
+    def batched_scrape_steps(self, filters: List[str], states: List[ScrapeState]) -> BatchedScrapeSteps:
+        while True:
+            batch = [i for i, state in enumerate(states) if state.windows][:self.alias_batch_size]
+            if not batch:
+                return
+            
+            for i in batch:
+                yield from self.probe_steps(filters[i], states[i])
+            
+            curr_batch_size = self.page_size.size
+            variables: Dict[str, Any] = {}
+            for alias, i in enumerate(batch):
+                start_date, end_date = states[i].windows[-1]
+                variables[f'query{alias}'] = self.search_query(filter=filters[i], start_date=start_date, end_date=end_date)
+                variables[f'first{alias}'] = curr_batch_size
+                variables[f'after{alias}'] = states[i].after
+                
+            try:
+                response = yield GraphQLRequest(batched_search_query(self.profile, len(batch)), variables, {'windows': batch, 'batch_size': curr_batch_size})
+                self.page_size.success(response.elapsed, response.data["rateLimit"]["cost"])
+                
+                # Demultiplex the aliased searches back into the streams of their windows
+                items_by_window = [(i, self.advance(states[i], response.data[f'search{alias}'])) for alias, i in enumerate(batch)]
+                
+                if self.profile == "deferred":
+                    yield from self.details_steps([item for _, items in items_by_window for item in items])
+                    
+                for i, items in items_by_window:
+                    for item in items:
+                        for obj in self.parse_item(item):
+                            yield i, obj
+                
+            except TimeoutError:
+                self.page_size.failure()
+                logging.warning(f"⚠️ Timeout: Reducing batch_size and retry! (batch_size {curr_batch_size} -> {self.page_size.size})")
+                    
+            for i in batch:
+                yield i, None
+    
+    def details_steps(self, items: List[Dict[str, Any]]) -> Generator[GraphQLRequest, GraphQLResponse, None]:
+        """
+        Second phase of the two-phase mode: fills commits, files and comments into light search nodes
+        through batched nodes(ids:) lookups. Each connection is only looked up for the pull requests
+        that need it: files if any changed, comments and commit authors if there are any (the authors of
+        the first commit take precedence over the branch and author in the classification). Files/comments
+        are followed beyond their first 100 nodes.
+        """
+        by_id = {item['id']: item for item in items}
+        for item in items:
+            item['commits'] = {'totalCount': item['commits']['totalCount'], 'nodes': []}
+            item['comments'] = {'totalCount': item['comments']['totalCount'], 'nodes': []}
+            item['files'] = {'nodes': []}
+        
+        pending = {
+            'authors': [item['id'] for item in items if item['commits']['totalCount'] > 0],
+            'files': [item['id'] for item in items if item['changedFiles'] > 0],
+            'discussions': [item['id'] for item in items if item['comments']['totalCount'] > 0],
+        }
+        follow_ups: List[Tuple[str, str, str]] = [] # (connection, node id, cursor)
+        
+        curr_batch_size = self.details_batch_size
+        while any(pending.values()):
+            batch = {lookup: ids[:curr_batch_size] for lookup, ids in pending.items()}
+            try:
+                response = yield GraphQLRequest(
+                    DETAILS_QUERY, {'commitIds': batch['authors'], 'fileIds': batch['files'], 'commentIds': batch['discussions']},
+                    {lookup: len(ids) for lookup, ids in batch.items()}, partial=True
+                )
+            except TimeoutError:
+                if curr_batch_size > 1:
+                    logging.warning(f"⚠️ Timeout: Reducing details batch_size and retry! (batch_size {curr_batch_size} -> {curr_batch_size//2})")
+                    curr_batch_size = curr_batch_size // 2
+                    continue
+                
+                # Keep the light nodes of pull requests that cannot be looked up instead of retrying forever
+                logging.warning(f"⚠️ Timeout: Giving up on the details of {batch}")
+                pending = {lookup: ids[len(batch[lookup]):] for lookup, ids in pending.items()}
+                continue
+            
+            pending = {lookup: ids[len(batch[lookup]):] for lookup, ids in pending.items()}
+            
+            # Nodes are None if the pull request vanished since the search
+            for node in filter(None, response.data['authors']):
+                by_id[node['id']]['commits'] = node['commits']
+                
+            for node in filter(None, response.data['files']):
+                by_id[node['id']]['files']['nodes'] = node['files']['nodes']
+                if node['files']['pageInfo']['hasNextPage']:
+                    follow_ups.append(('files', node['id'], node['files']['pageInfo']['endCursor']))
+                    
+            for node in filter(None, response.data['discussions']):
+                by_id[node['id']]['comments']['nodes'] = node['comments']['nodes']
+                if node['comments']['pageInfo']['hasNextPage']:
+                    follow_ups.append(('comments', node['id'], node['comments']['pageInfo']['endCursor']))
+                    
+        for connection, node_id, after in follow_ups:
+            query = FILES_PAGE_QUERY if connection == 'files' else COMMENTS_PAGE_QUERY
+            for _ in range(self.max_connection_pages - 1):
+                try:
+                    response = yield GraphQLRequest(query, {'id': node_id, 'after': after}, {connection: node_id, 'after': after}, partial=True)
+                except TimeoutError:
+                    logging.warning(f"⚠️ Timeout: Giving up on the remaining {connection} of {node_id}")
+                    break
+                
+                if response.data['node'] is None:
+                    break
+                
+                page = response.data['node'][connection]
+                by_id[node_id][connection]['nodes'] += page['nodes']
+                if not page['pageInfo']['hasNextPage']:
+                    break
+                after = page['pageInfo']['endCursor']
+            
+    def split_window(self, start_date: str, end_date: str, issue_count: int) -> List[Tuple[str, str]]:
+        """
+        Splits the (inclusive) window into consecutive sub-windows that are expected to hold at most
+        `search_fill` of the search limit each, assuming the results are spread evenly.
+        """
+        start = datetime.fromisoformat(start_date).replace(tzinfo=None)
+        end = datetime.fromisoformat(end_date).replace(tzinfo=None)
+        
+        seconds = int((end - start).total_seconds())
+        pieces = min(max(math.ceil(issue_count / (self.search_limit * self.search_fill)), 2), seconds + 1)
+        if pieces < 2:
+            return [(start_date, end_date)]
+        
+        bounds = [start + timedelta(seconds=(i * (seconds + 1)) // pieces) for i in range(pieces)]
+        return [
+            (
+                bounds[i].strftime(DATE_FORMAT),
+                (bounds[i + 1] - timedelta(seconds=1)).strftime(DATE_FORMAT) if i + 1 < pieces else end.strftime(DATE_FORMAT)
+            )
+            for i in range(pieces)
+        ]
+            
+    @staticmethod
+    def parse_status(item) -> PullRequestStatus:
+        return PullRequestStatus(
+            id=item['fullDatabaseId'],
+            closed_at=item['closedAt'],
+            isMerged=item['mergedAt'] is not None,
+            isDraft=item['isDraft'],
+        )
+            
+    @staticmethod
+    def parse_node(item, with_repositories=True) -> Iterator[PullRequest | Repository | RepositoryRef]:
+        yield PullRequest(
+            id=item['fullDatabaseId'],
+            url=item['url'],
+            title=item['title'],
+            body=item['bodyText'],
+            agent = None,
+            actor=Actor(
+                login=item['author'] and item['author']['login'],
+                type=item['author'] and item['author']['__typename']
+            ),
+            created_at = item['createdAt'],
+            closed_at = item['closedAt'],
+            updated_at = item['updatedAt'],
+            isMerged = item['mergedAt'] is not None,
+            isDraft= item['isDraft'],
+            additions = item['additions'],
+            deletions = item['deletions'],
+            changed_files = item['changedFiles'],
+            commits = item['commits']['totalCount'],
+            comments = item['comments']['totalCount'],
+            reviews = item['reviews']['totalCount'],
+            
+            base_ref = item['baseRefName'],
+            head_ref = item['headRefName'],
+            base_repo_id = item['baseRepository'] and item['baseRepository']['databaseId'],
+            head_repo_id = item['headRepository'] and item['headRepository']['databaseId'],
+            commitsList = [
+                Commit(authors=[
+                    CommitAuthor(name=x['name'], email=x['email'])
+                    for x in n['commit']['authors']['nodes']
+                ]) 
+                for n in item['commits']['nodes'] if n is not None
+            ],
+            files = [
+                PullRequestFile(additions=n['additions'], deletions=n['deletions'], path=n['path']) 
+                for n in item['files']['nodes'] if n is not None
+            ] if item['files'] is not None else None,
+            commentsList = [
+                Comment(
+                    id=n['databaseId'], 
+                    created_at=n['createdAt'],
+                    author=Actor(login=n['author']['login'], type=n['author']['__typename']) if n['author'] is not None else None,
+                    body=n['bodyText']) 
+                for n in item['comments']['nodes'] if n is not None
+            ] if item['comments'] is not None else None, 
+        )
+        
+        # Without their metadata, repositories are only referenced so that the refresher picks them up
+        for repo in [item['baseRepository'], item['headRepository']]:
+            if repo and with_repositories:
+                yield GitHubScraper.parse_repository(repo)
+            elif repo and 'id' in repo:
+                yield RepositoryRef(id=repo['databaseId'], node_id=repo['id'])
+            
+    @staticmethod
+    def parse_repository(repo) -> Repository:
+        return Repository(
+            id=repo['databaseId'],
+            name=repo['nameWithOwner'],
+            url=repo['url'],
+            is_fork=repo['isFork'],
+            stargazers=repo['stargazerCount'],
+            watchers=repo['watchers']['totalCount'],
+            forks=repo['forkCount'],
+            primary_language=repo['primaryLanguage'] and repo['primaryLanguage']['name'],
+            node_id=repo.get('id')
+        )
+
+    def search_query(self, filter: str, start_date: str, end_date: str) -> str:
+        return f"is:pr {filter} {self.time_key}:{start_date}..{end_date} sort:created-asc"
+
+    def build_request(self, filter: str, start_date: str, end_date: str, first: int, after: Optional[str], metadata=None) -> GraphQLRequest:
+        return GraphQLRequest(
+            query=PROFILES[self.profile],
+            variables={
+                "query": self.search_query(filter=filter, start_date=start_date, end_date=end_date),
+                "first": first,
+                "after": after,
+            },
+            metadata=metadata,
+        )
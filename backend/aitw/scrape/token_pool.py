@@ -0,0 +1,87 @@
+import logging
+import threading
+import time
+
+from dataclasses import dataclass
+from datetime import datetime
+from typing import Dict, List, Tuple
+
+
+@dataclass
+class TokenState:
+    name: str
+    token: str
+
+    limit: int = 5000
+    remaining: int = 5000
+    cost: int = 1
+    reset_at: float = 0.0 # Epoch seconds at which `remaining` is refilled to `limit`
+
+    not_before: float = 0.0 # Epoch seconds before which the token must not be used again
+
+    def headroom(self, now: float) -> int:
+        return self.limit if self.reset_at <= now else self.remaining
+
+    def spacing(self, now: float) -> float:
+        """Seconds between two requests such that the remaining points last until the reset."""
+        if self.reset_at <= now:
+            return 0.0
+
+        return (self.reset_at - now) * self.cost / max(self.remaining, 1)
+
+
+class TokenPool:
+    """
+    Routes requests across several GitHub tokens.
+
+    Every token tracks the rate limit reported by GitHub (remaining points, cost of the last query and
+    the reset time). Requests go to the token with the most headroom and are paced such that a token
+    spends its remaining points evenly until its reset, instead of hitting the limit and sleeping.
+    The pool is thread-safe and meant to be shared by all scrapers of a worker.
+    """
+
+    def __init__(self, tokens: List[str]):
+        if len(tokens) == 0:
+            raise ValueError('TokenPool requires at least one token')
+
+        self.tokens = [TokenState(name=f'token#{i}', token=t) for i, t in enumerate(tokens)]
+        self.lock = threading.Lock()
+
+    def acquire(self) -> Tuple[TokenState, float]:
+        """Picks the token to use for the next request and returns it with the seconds to wait before using it."""
+        with self.lock:
+            now = time.time()
+            state = min(self.tokens, key=lambda s: (max(s.not_before - now, 0), -s.headroom(now)))
+
+            wait = max(state.not_before - now, 0)
+            state.not_before = max(state.not_before, now) + state.spacing(now)
+
+            return state, wait
+
+    def update(self, state: TokenState, rate_limit: Dict):
+        """Updates the token from the `rateLimit { limit cost remaining resetAt }` object of a query."""
+        with self.lock:
+            state.cost = max(rate_limit.get('cost', state.cost), 1)
+            state.remaining = rate_limit.get('remaining', state.remaining)
+            state.limit = rate_limit.get('limit', state.limit)
+            if rate_limit.get('resetAt') is not None:
+                state.reset_at = datetime.fromisoformat(rate_limit['resetAt'].replace('Z', '+00:00')).timestamp()
+
+    def exhausted(self, state: TokenState, reset_at: float):
+        """Parks an exhausted token until its reset. Requests move to the other tokens meanwhile."""
+        with self.lock:
+            state.remaining = 0
+            state.reset_at = reset_at
+            state.not_before = max(state.not_before, reset_at)
+
+        logging.info(f'🔁 {state.name} exhausted, parked for {reset_at - time.time():.0f}s')
+
+    def delay(self, state: TokenState, seconds: float):
+        """Delays the next use of a token, e.g. because of a secondary rate limit (Retry-After)."""
+        with self.lock:
+            state.not_before = max(state.not_before, time.time() + seconds)
+
+    def summary(self) -> str:
+        with self.lock:
+            now = time.time()
+            return ', '.join(f'{s.name}: {s.headroom(now)}/{s.limit}' for s in self.tokens)
@@ -1,84 +1,305 @@
 import traceback
 import logging
 import time
-from typing import Optional
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from itertools import groupby
+from dataclasses import dataclass
+from typing import Any, Dict, Iterator, List, Optional, Set
 
+import requests
+from requests.adapters import HTTPAdapter
 from tqdm import tqdm
 
 from aitw.scrape.logging import setup_logging
 from aitw.scrape.pr_classifier import PrClassifier
-from aitw.database.pull_request_ingestor import BatchedPullRequestIngestor
-from aitw.database.repository_ingestor import BatchedRepositoryIngestor
-from aitw.database.pull_request import PullRequest
-from aitw.database.repository import Repository
-from aitw.database.connection import connect
+from aitw.database.pull_request_ingestor import BatchedPullRequestIngestor, BatchedPullRequestStatusIngestor
+from aitw.database.repository_ingestor import BatchedRepositoryIngestor, RecentRepositories
+from aitw.database.pull_request import PullRequest, PullRequestStatus
+from aitw.database.repository import Repository, RepositoryRef
+from aitw.database.connection import connection, ensure_pool_size, pool_stats
 
-from aitw.scrape.job import ScrapeJob, mark_job_done, mark_job_failed, pick_job
-from aitw.scrape.scraper import GitHubScraper
+from aitw.scrape.job import Heartbeat, JobEvents, ScrapeJob, lease_jobs, mark_job_done, mark_job_failed, save_checkpoint
+from aitw.scrape.page_size import PageSizeController
+from aitw.scrape.pipeline import Pipeline
+from aitw.scrape.queries import select_profile
+from aitw.scrape.scraper import GitHubScraper, ScrapeState
+from aitw.scrape.token_pool import TokenPool
 
 DATE_FROMAT = "%Y-%m-%dT%H:%M:%S"
+CHECKPOINT_INTERVAL = 30 # Seconds between checkpoints of a running job
+IDLE_TIMEOUT = 60 # Seconds an idle worker waits for job events before looking at the queue again
+LEASE_RETRY_DELAY = 5 # Seconds before leasing again after a failed attempt
+PIPELINE_QUEUE_SIZE = 500 # Scraped objects buffered between the stages of a job
 
-def execute_job(job: ScrapeJob, token: str, db_conn: str):
+@dataclass
+class PageBoundary:
+    """Passed down the pipeline after the objects of a search page, with the scrape state after it."""
+    state: Dict[str, Any]
+
+def classify_object(obj):
+    if isinstance(obj, PullRequest):
+        PrClassifier.classify(obj)
+    return obj
+
+def ingest_object(obj, seen: Set[int], pr_ingestor, status_ingestor, repo_ingestor) -> bool:
+    """Ingests a scraped (and classified) object. Returns whether it was a pull request not seen before."""
+    if isinstance(obj, PullRequest):
+        if obj.id in seen:
+            return False
+        
+        pr_ingestor.ingest(obj)
+        
+        seen.add(obj.id)
+        return True
+        
+    if isinstance(obj, PullRequestStatus):
+        if obj.id in seen:
+            return False
+        
+        status_ingestor.ingest(obj)
+        
+        seen.add(obj.id)
+        return True
+        
+    if isinstance(obj, Repository):
+        repo_ingestor.ingest(obj)
+        
+    if isinstance(obj, RepositoryRef):
+        repo_ingestor.ingest_ref(obj)
+        
+    return False
+
+def shared_page_size(page_sizes: Optional[Dict[str, PageSizeController]], profile: str, batched=False) -> Optional[PageSizeController]:
+    """Page size controllers are kept per query profile across the jobs of a worker, so they keep learning."""
+    if page_sizes is None:
+        return None
+    
+    key = f'{profile}-batched' if batched else profile
+    if key not in page_sizes:
+        page_sizes[key] = GitHubScraper.page_size_controller(profile)
+    return page_sizes[key]
+
+def execute_job(job: ScrapeJob, tokens: TokenPool, db_conn: str, two_phase=False, page_sizes: Optional[Dict[str, PageSizeController]] = None,
+                session: Optional[requests.Session] = None, recent_repos: Optional[RecentRepositories] = None):
     start_date = job.from_date.strftime(DATE_FROMAT)
     end_date = job.to_date.strftime(DATE_FROMAT)
     query = job.query
 
     logging.info(f'ℹ️  Executing job id={job.id} group={job.group} start={start_date} end={end_date} query={query}...')
         
-    scraper = GitHubScraper(token, time_key=job.time_key)
+    profile = select_profile(job.group, job.time_key, two_phase=two_phase)
+    scraper = GitHubScraper(tokens, time_key=job.time_key, session=session, profile=profile, page_size=shared_page_size(page_sizes, profile))
             
-    conn = connect(db_conn)
-    pr_ingestor = BatchedPullRequestIngestor(conn, conn.cursor())
-    repo_ingestor = BatchedRepositoryIngestor(conn, conn.cursor())
-    
-    seen = set()
-    expected_total = scraper.count(start_date=start_date, end_date=end_date, filter=query)
-    logging.info(f'ℹ️  Expecting to scrape {expected_total} pull requests')
-    with tqdm(total=expected_total) as lbar: 
-        for obj in scraper.scrape(start_date=start_date, end_date=end_date, filter=query):
-            if isinstance(obj, PullRequest):
-                if obj.id in seen:
-                    continue
-                
-                PrClassifier.classify(obj)
-                pr_ingestor.ingest(obj)
-                
-                seen.add(obj.id)
-                lbar.update(1)
+    with connection(db_conn) as conn:
+        pr_ingestor = BatchedPullRequestIngestor(conn, conn.cursor())
+        status_ingestor = BatchedPullRequestStatusIngestor(conn, conn.cursor())
+        repo_ingestor = BatchedRepositoryIngestor(conn, conn.cursor(), recent=recent_repos)
+    
+        # A retried job resumes from the checkpoint of its previous attempt instead of re-fetching
+        # every page of the window
+        checkpoint = job.checkpoint or {}
+        state = ScrapeState.from_dict(checkpoint['state']) if 'state' in checkpoint else None
+        seen: Set[int] = set(checkpoint.get('seen', []))
+        if state is not None:
+            logging.info(f'♻️  Resuming job id={job.id} with {len(state.windows)} pending windows after={state.after} ({checkpoint["flushed"]} pull requests already ingested)')
+    
+        def fetch() -> Iterator[Any]:
+            for obj in scraper.scrape(start_date=start_date, end_date=end_date, filter=query, state=state):
+                # The state is only consistent between pages, the writer checkpoints the state of the
+                # page it has written (the fetcher is ahead of it)
+                yield PageBoundary(scraper.state.to_dict()) if obj is None and scraper.state is not None else obj
+    
+        # Fetching, classification and writing run on their own threads: requests stay in flight while
+        # the writer (this thread) waits for the database
+        last_checkpoint = time.time()
+        with tqdm(initial=len(seen)) as lbar, Pipeline(fetch(), [classify_object], maxsize=PIPELINE_QUEUE_SIZE) as pipeline: 
+            for obj in pipeline:
+                if lbar.total is None and scraper.expected_total is not None:
+                    lbar.total = scraper.expected_total
+                    logging.info(f'ℹ️  Expecting to scrape {lbar.total} pull requests')
                 
-            if isinstance(obj, Repository):
-                repo_ingestor.ingest(obj)
+                if ingest_object(obj, seen, pr_ingestor, status_ingestor, repo_ingestor):
+                    lbar.update(1)
+            
+                if isinstance(obj, PageBoundary) and time.time() - last_checkpoint > CHECKPOINT_INTERVAL:
+                    checkpoint_job(job, obj.state, seen, conn, pr_ingestor, status_ingestor, repo_ingestor)
+                    last_checkpoint = time.time()
                 
-            lbar.update(0)
+                lbar.update(0)
         
-    if len(seen) != expected_total:
-        logging.warning(f'⚠️  Worker has seen {len(seen)} but expected to see {expected_total} ({start_date=} {end_date=} {query=})')
+        expected_total = scraper.expected_total
+        if len(seen) != expected_total:
+            logging.warning(f'⚠️  Worker has seen {len(seen)} but expected to see {expected_total} ({start_date=} {end_date=} {query=})')
+        logging.info(f'ℹ️  Scrape progress: {scraper.progress()}')
+    
+        pr_ingestor.flush()
+        status_ingestor.flush()
+        repo_ingestor.flush()
+        log_ingest_stats(pr_ingestor, status_ingestor, repo_ingestor)
     
+def log_ingest_stats(pr_ingestor, status_ingestor, repo_ingestor):
+    """Rows that were written and rows that were skipped because nothing changed."""
+    logging.info(f'📊 Ingest stats: prs={pr_ingestor.stats()} statuses={status_ingestor.stats()} repos={repo_ingestor.stats()}')
+    
+def checkpoint_job(job: ScrapeJob, state: Dict[str, Any], seen: Set[int], conn, pr_ingestor, status_ingestor, repo_ingestor):
+    """Flushes everything scraped so far and persists the scrape state of the job."""
     pr_ingestor.flush()
+    status_ingestor.flush()
     repo_ingestor.flush()
     
-    conn.close()
+    save_checkpoint(conn, job, {
+        'state': state,
+        'seen': sorted(seen),
+        'flushed': len(seen),
+    })
+    logging.info(f'💾 Checkpoint of job id={job.id}: {len(seen)} pull requests, {len(state["windows"])} pending windows')
+    
+def execute_batched_jobs(jobs: List[ScrapeJob], tokens: TokenPool, db_conn: str, two_phase=False, page_sizes: Optional[Dict[str, PageSizeController]] = None,
+                         session: Optional[requests.Session] = None, recent_repos: Optional[RecentRepositories] = None):
+    """
+    Executes several jobs of the same group and time key together. Every request carries the next
+    search page of up to GitHubScraper.alias_batch_size jobs, which amortizes the round trip for
+    sparse jobs (e.g. the minute windows of the update group).
+    """
+    group, time_key = jobs[0].group, jobs[0].time_key
+    windows = [(job.from_date.strftime(DATE_FROMAT), job.to_date.strftime(DATE_FROMAT), job.query) for job in jobs]
+    
+    logging.info(f'ℹ️  Executing {len(jobs)} batched jobs ids={[job.id for job in jobs]} group={group} time_key={time_key}...')
+    
+    profile = select_profile(group, time_key, two_phase=two_phase)
+    scraper = GitHubScraper(tokens, time_key=time_key, session=session, profile=profile, page_size=shared_page_size(page_sizes, profile, batched=True))
+    
+    with connection(db_conn) as conn:
+        pr_ingestor = BatchedPullRequestIngestor(conn, conn.cursor())
+        status_ingestor = BatchedPullRequestStatusIngestor(conn, conn.cursor())
+        repo_ingestor = BatchedRepositoryIngestor(conn, conn.cursor(), recent=recent_repos)
     
-def worker(token, id, group, db_conn):
-    print(f'Using GitHub token: {token}')
+        seen: List[Set[int]] = [set() for _ in jobs]
+        def classify_indexed(indexed):
+            return indexed[0], classify_object(indexed[1])
+    
+        with tqdm() as lbar, Pipeline(scraper.scrape_batched(windows), [classify_indexed], maxsize=PIPELINE_QUEUE_SIZE) as pipeline:
+            for index, obj in pipeline:
+                if ingest_object(obj, seen[index], pr_ingestor, status_ingestor, repo_ingestor):
+                    lbar.update(1)
+                
+        for job, state, job_seen in zip(jobs, scraper.states, seen):
+            if len(job_seen) != state.expected:
+                logging.warning(f'⚠️  Worker has seen {len(job_seen)} but expected to see {state.expected} (job={job.id})')
+        logging.info(f'ℹ️  Scrape progress: requests={scraper.requests} cost={scraper.cost} prs={sum(len(s) for s in seen)} {scraper.page_size.stats()}')
+    
+        pr_ingestor.flush()
+        status_ingestor.flush()
+        repo_ingestor.flush()
+        log_ingest_stats(pr_ingestor, status_ingestor, repo_ingestor)
+    
+def worker(tokens, id, group, db_conn, two_phase=False, batch=1, concurrency=1):
+    token_pool = TokenPool(list(tokens))
+    print(f'Using {len(token_pool.tokens)} GitHub token(s)')
     if group is not None:
         print(f'Only working on jobs of group {group}')
+    if concurrency > 1:
+        print(f'Running up to {concurrency} jobs at once')
     setup_logging(id)
     
-    while True:
-        job: Optional[ScrapeJob] = pick_job(db_conn, group)
-        
-        if job is None:
-            logging.info('ℹ️  No jobs pending. Retry in 10s...')
-            time.sleep(10)
-            continue
+    work(token_pool, group, db_conn, two_phase=two_phase, batch=batch, concurrency=concurrency, worker_id=str(id))
+    
+def work(token_pool: TokenPool, group: Optional[str], db_conn: str, two_phase=False, batch=1, concurrency=1,
+         page_sizes: Optional[Dict[str, PageSizeController]] = None, until_idle=False, worker_id: Optional[str] = None):
+    """
+    Claims and runs jobs, forever or (`until_idle`) until no job is pending. With a concurrency above
+    one, up to `concurrency` jobs (or batches of jobs) run at once on threads that share the HTTP
+    connections, the token pool, the page size controllers, the recently written repositories and a
+    pool of database connections.
+    A failing job only fails itself.
+    
+    All jobs for the free slots are leased in one round trip and kept alive with heartbeats.
+    """
+    page_sizes = page_sizes if page_sizes is not None else {}
+    recent_repos = RecentRepositories()
+    session = requests.Session()
+    for prefix in ['https://', 'http://']:
+        session.mount(prefix, HTTPAdapter(pool_maxsize=concurrency))
+    # Every running job holds a connection to write, claiming and marking jobs needs one more
+    ensure_pool_size(db_conn, concurrency + 1)
+    
+    running: Set[Future] = set()
+    events: Optional[JobEvents] = None
+    try:
+        with Heartbeat(db_conn) as heartbeat, ThreadPoolExecutor(max_workers=concurrency, thread_name_prefix='job') as executor:
+            def run_leased_jobs(jobs: List[ScrapeJob]):
+                try:
+                    run_jobs(jobs, token_pool, db_conn, two_phase, page_sizes, session, recent_repos)
+                finally:
+                    heartbeat.remove(jobs)
+            
+            while True:
+                if len(running) < concurrency:
+                    try:
+                        jobs = lease_jobs(db_conn, group, (concurrency - len(running)) * batch, worker_id=worker_id)
+                    except Exception as ex:
+                        # E.g. a lost connection or a serialization failure, the running jobs carry on meanwhile
+                        logging.warning(f'⚠️  Leasing jobs failed: {ex}')
+                        time.sleep(LEASE_RETRY_DELAY)
+                        continue
+                    heartbeat.add(jobs)
+
+                    if len(jobs) > 0 and events is not None:
+                        # Busy workers stop listening: unread notifications would pile up and hold back
+                        # the NOTIFY queue of the whole fleet
+                        events.close()
+                        events = None
+
+                    # Only jobs of the same group and time key share a query profile and can be batched,
+                    # batches are split to spread the jobs over the free slots
+                    for _, grouped_jobs in groupby(sorted(jobs, key=batch_key), key=batch_key):
+                        batchable_jobs = list(grouped_jobs)
+                        for i in range(0, len(batchable_jobs), batch):
+                            running.add(executor.submit(run_leased_jobs, batchable_jobs[i:i + batch]))
+                    
+                    if len(jobs) == 0 and len(running) == 0:
+                        if until_idle:
+                            return
+                        
+                        if events is None:
+                            # Starts listening before the queue is looked at again, so no submission is missed
+                            events = JobEvents(db_conn)
+                            continue
+                        
+                        logging.info('ℹ️  No jobs pending. Waiting for new jobs...')
+                        events.wait_for_jobs(group, IDLE_TIMEOUT)
+                        continue
+                
+                # Wait for a free slot, but look for new jobs again after 10s if the queue was empty
+                _, running = wait(running, timeout=10, return_when=FIRST_COMPLETED)
+    finally:
+        if events is not None:
+            events.close()
+        session.close()
+            
+def batch_key(job: ScrapeJob):
+    return (job.group, job.time_key)
         
-        try:
-            execute_job(job=job, token=token, db_conn=db_conn)
-            mark_job_done(db_conn, job)
-        except Exception as ex:
-            mark_job_failed(db_conn, job)
+def run_jobs(jobs: List[ScrapeJob], token_pool: TokenPool, db_conn: str, two_phase: bool, page_sizes: Dict[str, PageSizeController],
+             session: Optional[requests.Session] = None, recent_repos: Optional[RecentRepositories] = None):
+    try:
+        if len(jobs) == 1:
+            execute_job(job=jobs[0], tokens=token_pool, db_conn=db_conn, two_phase=two_phase, page_sizes=page_sizes, session=session,
+                        recent_repos=recent_repos)
+        else:
+            execute_batched_jobs(jobs=jobs, tokens=token_pool, db_conn=db_conn, two_phase=two_phase, page_sizes=page_sizes, session=session,
+                                 recent_repos=recent_repos)
             
-            logging.error(f'❌ Exception while executing job={job}:')
-            logging.exception(ex)
-            traceback.print_exc()
\ No newline at end of file
+        for job in jobs:
+            if not mark_job_done(db_conn, job):
+                logging.warning(f'⚠️  Lost the lease of job id={job.id} before it was done, leaving it to its new worker')
+        logging.info(f'💰 Token budget: {token_pool.summary()}')
+        logging.info(f'🔌 Database pool: {pool_stats(db_conn)}')
+    except Exception as ex:
+        for job in jobs:
+            if not mark_job_failed(db_conn, job, error=traceback.format_exc()):
+                logging.warning(f'⚠️  Lost the lease of job id={job.id} before it failed, leaving it to its new worker')
+        
+        logging.error(f'❌ Exception while executing jobs={jobs}:')
+        logging.exception(ex)
+        traceback.print_exc()
\ No newline at end of file